@@ -0,0 +1,142 @@
+import datetime
+
+from sqlalchemy import DateTime, Integer, case, func, literal, literal_column
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from models import ENUM_COLUMNS, ENUM_VALUES, NUMERIC_COLUMNS, WeatherData
+
+BUCKET_WIDTHS = {
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1),
+}
+
+
+# Whole seconds from start to end, compiled per dialect so buckets can be computed in SQL
+class seconds_between(FunctionElement):
+    type = Integer()
+    name = 'seconds_between'
+    inherit_cache = True
+
+
+@compiles(seconds_between)
+def _seconds_between_default(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return 'CAST(EXTRACT(EPOCH FROM (%s - %s)) AS INTEGER)' % (compiler.process(end, **kw),
+                                                               compiler.process(start, **kw))
+
+
+@compiles(seconds_between, 'mysql')
+def _seconds_between_mysql(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return 'TIMESTAMPDIFF(SECOND, %s, %s)' % (compiler.process(start, **kw), compiler.process(end, **kw))
+
+
+@compiles(seconds_between, 'sqlite')
+def _seconds_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "(CAST(strftime('%%s', %s) AS INTEGER) - CAST(strftime('%%s', %s) AS INTEGER))" % (
+        compiler.process(end, **kw), compiler.process(start, **kw))
+
+
+# (start, end) of each bucket of the given width splitting [start, end] from start, the last
+# bucket is cut short at end. There is always at least one bucket.
+def bucket_bounds(start, end, width):
+    bucket_count = max(1, -(-(end - start) // width))
+    return [(start + i * width, min(start + (i + 1) * width, end)) for i in range(bucket_count)]
+
+
+# Partial aggregates of one time bucket. Sums, counts, extremes and enum histograms are
+# kept instead of averages so buckets can be merged before the averages are taken.
+class BucketAggregate:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.count = 0
+        self.sums = dict.fromkeys(NUMERIC_COLUMNS, 0.0)
+        self.mins = dict.fromkeys(NUMERIC_COLUMNS)
+        self.maxs = dict.fromkeys(NUMERIC_COLUMNS)
+        self.histograms = {column: dict.fromkeys(ENUM_VALUES[column], 0) for column in ENUM_COLUMNS}
+
+    def merge(self, count, sums, mins, maxs, histograms):
+        if not count:
+            return
+        self.count += count
+        for column in NUMERIC_COLUMNS:
+            self.sums[column] += sums[column] or 0.0
+            if mins[column] is not None and (self.mins[column] is None or mins[column] < self.mins[column]):
+                self.mins[column] = mins[column]
+            if maxs[column] is not None and (self.maxs[column] is None or maxs[column] > self.maxs[column]):
+                self.maxs[column] = maxs[column]
+        for column in ENUM_COLUMNS:
+            histogram = self.histograms[column]
+            for value, value_count in histograms[column].items():
+                histogram[value] += value_count or 0
+
+    def merge_bucket(self, other):
+        self.merge(other.count, other.sums, other.mins, other.maxs, other.histograms)
+
+    def averages(self):
+        if not self.count:
+            return dict.fromkeys(NUMERIC_COLUMNS)
+        return {column: self.sums[column] / self.count for column in NUMERIC_COLUMNS}
+
+    def modes(self):
+        result = {}
+        for column in ENUM_COLUMNS:
+            histogram = self.histograms[column]
+            value = max(histogram, key=histogram.get)
+            result[column] = value if histogram[value] else None
+        return result
+
+
+def _aggregate_columns():
+    columns = [func.count().label('count')]
+    for column in NUMERIC_COLUMNS:
+        attribute = getattr(WeatherData, column)
+        columns += [func.sum(attribute), func.min(attribute), func.max(attribute)]
+    for column in ENUM_COLUMNS:
+        attribute = getattr(WeatherData, column)
+        columns += [func.sum(case((attribute == value, 1), else_=0)) for value in ENUM_VALUES[column]]
+    return columns
+
+
+# Split a row laid out as _aggregate_columns() into count, sums, mins, maxs and histograms
+def unpack_aggregates(row):
+    count = row[0]
+    position = 1
+    sums, mins, maxs, histograms = {}, {}, {}, {}
+    for column in NUMERIC_COLUMNS:
+        sums[column], mins[column], maxs[column] = row[position:position + 3]
+        position += 3
+    for column in ENUM_COLUMNS:
+        values = ENUM_VALUES[column]
+        histograms[column] = dict(zip(values, row[position:position + len(values)]))
+        position += len(values)
+    return count, sums, mins, maxs, histograms
+
+
+# Run one grouped SELECT over the readings matching criteria, bucketed by whole widths
+# from origin. Returns (bucket index, count, sums, mins, maxs, histograms) per non-empty bucket.
+def bucket_rows(session, origin, width, *criteria):
+    bucket = (seconds_between(literal(origin, DateTime), WeatherData.timestamp)
+              // int(width.total_seconds())).label('bucket')
+    rows = session.query(bucket, *_aggregate_columns()) \
+        .filter(*criteria) \
+        .group_by(literal_column('bucket')) \
+        .all()
+    return [(int(row[0]), *unpack_aggregates(row[1:])) for row in rows]
+
+
+# Aggregate all columns over [start, end] split into buckets of the given width, with a
+# single grouped SELECT. Buckets are half open, except the last one which also holds the
+# readings at end unless include_end is False. Returns one BucketAggregate per bucket,
+# empty buckets included.
+def aggregate_buckets(session, start, end, width, include_end=True):
+    buckets = [BucketAggregate(lo, hi) for lo, hi in bucket_bounds(start, end, width)]
+    bucket_count = len(buckets)
+
+    upper_bound = WeatherData.timestamp <= end if include_end else WeatherData.timestamp < end
+    for index, *aggregates in bucket_rows(session, start, width, WeatherData.timestamp >= start, upper_bound):
+        buckets[min(index, bucket_count - 1)].merge(*aggregates)
+    return buckets
@@ -0,0 +1,131 @@
+import numpy as np
+from sqlalchemy import DateTime, literal, select
+from models import NUMERIC_COLUMNS, WeatherData
+from aggregation import bucket_bounds, seconds_between
+
+# Float columns summarized with min, max, mean, standard deviation and percentiles
+STAT_COLUMNS = [column for column in NUMERIC_COLUMNS if column != 'wind_direction_degrees']
+
+DEFAULT_PERCENTILES = (5, 50, 95)
+
+# Decimals of the values in the analytics responses
+DECIMALS = 4
+
+_ANALYTICS_COLUMNS = ['wind_direction_degrees'] + STAT_COLUMNS
+
+
+# Load every reading of [start, end] in one fetch, as seconds since start plus one float array per column
+def load_window(session, start, end):
+    offset = seconds_between(literal(start, DateTime), WeatherData.timestamp)
+    result = session.execute(select(offset, *[getattr(WeatherData, column) for column in _ANALYTICS_COLUMNS])
+                             .where(WeatherData.timestamp.between(start, end))
+                             .order_by(WeatherData.timestamp.asc()))
+    # Plain tuples, NumPy converts Row objects several times slower
+    rows = [tuple(row) for row in result]
+    values = np.array(rows, dtype=np.float64).reshape(len(rows), len(_ANALYTICS_COLUMNS) + 1)
+    return values[:, 0], {column: values[:, i + 1] for i, column in enumerate(_ANALYTICS_COLUMNS)}
+
+
+# Vapour pressure deficit in kPa, from the Tetens saturation vapour pressure
+def vapour_pressure_deficit(temperature_c, relative_humidity_perc):
+    saturation = 0.6108 * np.exp(17.27 * temperature_c / (temperature_c + 237.3))
+    return saturation * (1 - relative_humidity_perc / 100)
+
+
+# Rounded list of an array with None in place of NaN, ready for JSON
+def _nullable(array):
+    values = np.round(array, DECIMALS).astype(object)
+    values[np.isnan(array)] = None
+    return values.tolist()
+
+
+# Circular mean in degrees of the directions per bucket, in [0, 360) and rounded to DECIMALS, and the
+# length of the mean resultant vector, 1 for a steady direction and close to 0 for a variable one.
+# NaN for empty buckets.
+def circular_statistics(degrees, buckets, bucket_count):
+    radians = np.deg2rad(degrees)
+    valid = ~np.isnan(radians)
+    counts = np.bincount(buckets[valid], minlength=bucket_count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosines = np.bincount(buckets[valid], weights=np.cos(radians[valid]), minlength=bucket_count) / counts
+        sines = np.bincount(buckets[valid], weights=np.sin(radians[valid]), minlength=bucket_count) / counts
+    # Means just below 0 come out of np.mod, or its rounding, as 360
+    means = np.round(np.mod(np.rad2deg(np.arctan2(sines, cosines)), 360), DECIMALS)
+    return np.where(means >= 360, means - 360, means), np.hypot(sines, cosines)
+
+
+# Min, max, mean, standard deviation and percentiles of values per bucket, NaN readings left out.
+# buckets holds the ascending bucket index of every value. Returns {statistic: array per bucket}.
+def bucket_statistics(values, buckets, bucket_count, percentiles):
+    valid = ~np.isnan(values)
+    counts = np.bincount(buckets[valid], minlength=bucket_count)
+    present = counts > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Shift by the overall mean so the sum of squares keeps its precision
+        shift = values[valid].mean() if valid.any() else 0.0
+        shifted = np.where(valid, values - shift, 0.0)
+        sums = np.bincount(buckets, weights=shifted, minlength=bucket_count)
+        squares = np.bincount(buckets, weights=shifted * shifted, minlength=bucket_count)
+        means = sums / counts
+        stats = {
+            'mean': means + shift,
+            'std': np.sqrt(np.maximum(squares / counts - means * means, 0.0)),
+            'min': np.full(bucket_count, np.nan),
+            'max': np.full(bucket_count, np.nan),
+        }
+
+    # Rows are ordered by time, so every bucket is one contiguous slice
+    starts = np.searchsorted(buckets, np.arange(bucket_count))
+    non_empty = starts < np.append(starts[1:], len(buckets))
+    if non_empty.any():
+        stats['min'][non_empty] = np.fmin.reduceat(values, starts[non_empty])
+        stats['max'][non_empty] = np.fmax.reduceat(values, starts[non_empty])
+
+    # Sort by bucket then value, NaN last, and interpolate between the ranks of each percentile
+    order = np.lexsort((values, buckets))
+    ordered = values[order]
+    first = np.searchsorted(buckets[order], np.arange(bucket_count))
+    for percentile in percentiles:
+        rank = (counts - 1).clip(min=0) * percentile / 100
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.ceil(rank).astype(np.int64)
+        result = np.full(bucket_count, np.nan)
+        if present.any():
+            low = ordered[first[present] + lower[present]]
+            high = ordered[first[present] + upper[present]]
+            fraction = rank[present] - lower[present]
+            result[present] = low + (high - low) * fraction
+        stats[f'p{percentile:g}'] = result
+    return stats
+
+
+# Per bucket statistics of the readings in [start, end], split into buckets of width from start
+# with the last bucket also holding the readings at end. All the work is done on whole columns.
+def window_analytics(session, start, end, width, percentiles=DEFAULT_PERCENTILES):
+    bounds = bucket_bounds(start, end, width)
+    bucket_count = len(bounds)
+    offsets, columns = load_window(session, start, end)
+    buckets = np.minimum(offsets // width.total_seconds(), bucket_count - 1).astype(np.int64)
+    counts = np.bincount(buckets, minlength=bucket_count)
+
+    circular_mean, resultant_length = circular_statistics(columns['wind_direction_degrees'], buckets, bucket_count)
+    statistics = {column: bucket_statistics(columns[column], buckets, bucket_count, percentiles)
+                  for column in STAT_COLUMNS}
+    statistics['vapour_pressure_deficit_kpa'] = bucket_statistics(
+        vapour_pressure_deficit(columns['external_temperature_c'], columns['relative_humidity_perc']),
+        buckets, bucket_count, percentiles)
+
+    wind = {'circular_mean_degrees': _nullable(circular_mean), 'resultant_length': _nullable(resultant_length)}
+    columns_by_bucket = {column: {name: _nullable(values) for name, values in stats.items()}
+                         for column, stats in statistics.items()}
+    result = []
+    for i, (bucket_start, bucket_end) in enumerate(bounds):
+        result.append({
+            'start': str(bucket_start),
+            'end': str(bucket_end),
+            'count': int(counts[i]),
+            'wind_direction': {name: values[i] for name, values in wind.items()},
+            'columns': {column: {name: values[i] for name, values in stats.items()}
+                        for column, stats in columns_by_bucket.items()},
+        })
+    return result
@@ -0,0 +1,182 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+COMPASS = ['N', 'NNO', 'NO', 'ONO', 'O', 'OZO', 'ZO', 'ZZO', 'Z', 'ZZW', 'ZW', 'WZW', 'W', 'WNW', 'NW', 'NNW']
+
+# Labels of the 'rows' entries in a climate computer dump, in the positions ingest.ROW_INDEXES reads
+ROW_LABELS = [
+    'Tijd', 'Buitentemperatuur', 'Windsnelheid ongedempt', 'Windsnelheid', 'Windrichting graden',
+    'Windrichting kompas', 'Stralingsintensiteit ongedempt', 'Stralingsintensiteit', 'Standaard stralingsintensiteit',
+    'Stralingssom', 'Straling van plant', 'Neerslag', 'Relatieve vochtigheid', 'Vochtdeficit g/kg',
+    'Vochtdeficit g/m3', 'Dauwpunttemperatuur', 'Absolute vochtigheid', 'Enthalpie kJ/kg', 'Enthalpie kJ/m3',
+    'Luchtdruk', 'Status meteostation', 'Status communicatie meteostation',
+]
+
+
+def _enum(key, value):
+    return {'type': 'hortimax.synopta.enum', 'key': key, 'value': value}
+
+
+# One synthetic 5 minute reading with a day/night cycle, in the {'ts': ..., 'rows': [...]} dump format
+def synthetic_reading(timestamp, rng):
+    day_fraction = (timestamp.hour * 60 + timestamp.minute) / 1440
+    sun = max(0.0, math.sin((day_fraction - 0.25) * 2 * math.pi))
+    temperature = 12 + 8 * sun + rng.gauss(0, 0.5)
+    humidity = min(100.0, max(20.0, 85 - 35 * sun + rng.gauss(0, 2)))
+    radiation = 850 * sun + abs(rng.gauss(0, 10))
+    wind_speed = abs(rng.gauss(4, 1.5))
+    wind_degrees = int(rng.vonmisesvariate(math.radians(240), 2) * 180 / math.pi) % 360
+    values = [
+        timestamp.isoformat(), round(temperature, 2), round(wind_speed * 1.1, 2), round(wind_speed, 2), wind_degrees,
+        _enum(8787, COMPASS[round(wind_degrees / 22.5) % 16]), round(radiation * 1.05, 1), round(radiation, 1),
+        round(radiation * 0.9, 1), round(radiation * day_fraction * 300 / 1e4, 2), round(radiation * 0.2, 1),
+        round(max(0.0, rng.gauss(-0.5, 0.4)), 2), round(humidity, 1), round((100 - humidity) * 0.08, 2),
+        round((100 - humidity) * 0.1, 2), round(temperature - (100 - humidity) / 5, 2), round(humidity * 0.09, 2),
+        round(25 + temperature * 1.5, 2), round(30 + temperature * 1.8, 2), round(rng.gauss(1013, 4), 1),
+        _enum(8789, 'Actief'), _enum(8796, 'Online' if rng.random() > 0.01 else 'Offline'),
+    ]
+    return {'ts': timestamp.strftime('%Y-%m-%dT%H:%M:%S') + '+02:00',
+            'rows': [[label, value] for label, value in zip(ROW_LABELS, values)]}
+
+
+# Write an archive of days of 5 minute readings laid out like the climate computer export
+def write_archive(path, start, days, seed=0):
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for step in range(days * 288):
+            timestamp = start + datetime.timedelta(minutes=5 * step)
+            folder = timestamp.strftime('%B').lower()
+            zip_ref.writestr(f'{folder}/{timestamp:%Y%m%d_%H%M}.json', json.dumps(synthetic_reading(timestamp, rng)))
+    return days * 288
+
+
+def _timed(call, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started) * 1000)
+    return {'median_ms': round(statistics.median(timings), 3), 'min_ms': round(min(timings), 3),
+            'max_ms': round(max(timings), 3), 'repeat': repeat}
+
+
+# Ingest an archive through /consume-raw-data and wait for the job, returns its final status and the seconds taken
+def _ingest(client, archive_path, workers):
+    started = time.perf_counter()
+    queued = client.post('/consume-raw-data', json={'folder_path': archive_path, 'workers': workers})
+    status = client.get(queued.json['status_url']).json
+    while status['status'] in ('queued', 'running'):
+        time.sleep(0.05)
+        status = client.get(queued.json['status_url']).json
+    return status, time.perf_counter() - started
+
+
+# Ingest an archive of the given size into an empty database, then time every read endpoint
+def run_size(main, database, days, repeat, workdir, workers):
+    from cache import response_cache
+    from hot_store import hot_store
+
+    # Not while the store is still loading from the tables dropped below
+    hot_store.wait_loaded()
+    database.Base.metadata.drop_all(database.engine)
+    database.Base.metadata.create_all(database.engine)
+    response_cache.clear()
+    # Forget the previous size's readings, the store is reloaded from the new tables below
+    hot_store.enabled = True
+    hot_store.invalidate()
+    archive_path = os.path.join(workdir, f'synthetic_{days}d.zip')
+    start = datetime.datetime(2023, 5, 1)
+    readings = write_archive(archive_path, start, days)
+    client = main.app.test_client()
+
+    status, ingest_seconds = _ingest(client, archive_path, workers)
+    hot_store.warm()
+
+    requests = {
+        'latest': ('/api/weather-latest_modifications', None),
+        'last_day_weather': ('/api/last_day_weather', {'interval': 15}),
+        'avg_for_several_days': ('/api/avg-for-several-days', {'total_days': min(days, 14)}),
+        'avg_for_several_days_with_one_day_increment': (
+            '/api/avg-for-several-days-with-one-day-increment', {'total_days': min(days, 14), 'increment_interval': 1}),
+    }
+    endpoints = {}
+    for name, (url, body) in requests.items():
+        def cold():
+            response_cache.clear()
+            assert client.get(url, json=body).status_code == 200, url
+
+        def warm():
+            assert client.get(url, json=body).status_code == 200, url
+
+        # db_cold reads from the database like the endpoints did before the in-memory store,
+        # cold from the in-memory store and warm from the response cache
+        hot_store.enabled = False
+        db_cold = _timed(cold, repeat)
+        hot_store.enabled = True
+        endpoints[name] = {'db_cold': db_cold, 'cold': _timed(cold, repeat), 'warm': _timed(warm, repeat)}
+
+    # Ingest the following day while the in-memory store is warm, the path every live ingest takes
+    next_path = os.path.join(workdir, f'synthetic_{days}d_next.zip')
+    next_readings = write_archive(next_path, start + datetime.timedelta(days=days), 1, seed=days)
+    next_status, next_seconds = _ingest(client, next_path, workers)
+    assert next_status['status'] == 'succeeded' and next_status['rows_inserted'] == next_readings, next_status
+    assert client.get('/api/weather-latest_modifications').json['timestamp'] == \
+        str(start + datetime.timedelta(days=days + 1) - datetime.timedelta(minutes=5))
+
+    return {
+        'days': days,
+        'readings': readings,
+        'ingest': {'status': status['status'], 'rows_inserted': status['rows_inserted'],
+                   'seconds': round(ingest_seconds, 3),
+                   'rows_per_second': round(status['rows_inserted'] / ingest_seconds, 1)},
+        'incremental_ingest': {'status': next_status['status'], 'rows_inserted': next_status['rows_inserted'],
+                               'seconds': round(next_seconds, 3)},
+        'endpoints': endpoints,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time ingest and the read endpoints on synthetic data.')
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 7, 30, 90],
+                        help='data sizes to benchmark, in days of 5 minute readings')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per endpoint')
+    parser.add_argument('--workers', type=int, default=1, help='parser processes used by the ingest')
+    parser.add_argument('--database-url',
+                        help='database to benchmark against, its tables are dropped and recreated. '
+                             'A temporary SQLite file by default')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Must be set before database.py builds the engine
+        os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+        import database
+        import models
+        # main starts loading the in-memory store on import, give it tables to read
+        database.Base.metadata.create_all(database.engine)
+        import main
+
+        results = {
+            'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'dialect': database.engine.dialect.name,
+            'sizes': [run_size(main, database, days, args.repeat, workdir, args.workers) for days in args.days],
+        }
+        database.engine.dispose()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
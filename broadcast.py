@@ -0,0 +1,71 @@
+import threading
+import time
+
+from models import WeatherData
+from database import Session
+from serializers import READING_COLUMNS, dumps, serialize_reading
+
+
+# Holds the serialized latest reading and wakes every waiting client when ingest commits a
+# newer one, so connected dashboards cost one query per new reading instead of one per poll.
+# Ingests run by other processes are picked up by refresh, which the stream calls between heartbeats.
+class LatestReadingBroadcaster:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._primed = False
+        self._timestamp = None
+        self._body = None
+        self._refreshed_at = None
+
+    def _load(self):
+        session = Session()
+        try:
+            latest = session.query(*READING_COLUMNS).order_by(WeatherData.timestamp.desc()).first()
+        finally:
+            session.close()
+        with self._condition:
+            self._primed = True
+            if latest is not None and (self._timestamp is None or latest.timestamp > self._timestamp):
+                self._timestamp = latest.timestamp
+                self._body = dumps(serialize_reading(latest))
+                self._condition.notify_all()
+
+    # Load the latest reading once, before the first client waits on it
+    def prime(self):
+        if not self._primed:
+            self._load()
+
+    # Called after ingest committed readings up to timestamp, reloads and wakes the clients if it is newer
+    def committed(self, timestamp):
+        with self._condition:
+            if self._primed and self._timestamp is not None and timestamp <= self._timestamp:
+                return
+        try:
+            self._load()
+        except Exception as e:
+            print(f'Error occurred while publishing the latest reading: {str(e)}')
+
+    # Reload the latest reading to pick up readings committed by other processes, at most once per
+    # interval seconds whatever the number of waiting clients
+    def refresh(self, interval):
+        with self._condition:
+            now = time.monotonic()
+            if self._refreshed_at is not None and now - self._refreshed_at < interval:
+                return
+            self._refreshed_at = now
+        try:
+            self._load()
+        except Exception as e:
+            print(f'Error occurred while refreshing the latest reading: {str(e)}')
+
+    # Wait up to timeout seconds for a reading newer than after, None for any reading.
+    # Returns (timestamp, serialized body), or None on timeout.
+    def wait(self, after, timeout):
+        with self._condition:
+            if self._condition.wait_for(lambda: self._timestamp is not None and
+                                        (after is None or self._timestamp > after), timeout):
+                return self._timestamp, self._body
+            return None
+
+
+latest_readings = LatestReadingBroadcaster()
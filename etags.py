@@ -0,0 +1,56 @@
+import hashlib
+
+from flask import Response, request
+from sqlalchemy import func, select
+from models import IngestManifest, WeatherData
+from database import Session
+from cache import response_cache
+
+
+# Changes whenever readings are ingested: the latest reading timestamp, plus the latest manifest
+# entry so that re-ingesting older readings also counts. None while there is no data.
+def load_data_version(session=None):
+    latest_timestamp, latest_file = (session or Session()).execute(select(
+        select(func.max(WeatherData.timestamp)).scalar_subquery(),
+        select(func.max(IngestManifest.id)).scalar_subquery())).one()
+    if latest_timestamp is None:
+        return None
+    return f'{latest_timestamp.isoformat()}/{latest_file}'
+
+
+def request_etag(version):
+    digest = hashlib.sha1()
+    for part in (request.path.encode(), request.query_string, request.get_data(), version.encode()):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# Tag a response with the ETag of the request and the version of the data its body was built from
+def tagged(response, version):
+    # Weak, the same tag is sent whatever the content encoding
+    response.set_etag(request_etag(version), weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+
+# 304 response when If-None-Match holds the ETag of version, None when the body has to be sent
+def not_modified(version):
+    if request.if_none_match.contains_weak(request_etag(version)):
+        return tagged(Response(status=304), version)
+    return None
+
+
+# Serve a read endpoint from the response cache, where each body is stored with the version of the
+# data it was built from. compute returns (version, body), read in that order so the body is never
+# older than its version, or None when there is no data; None is then returned as well. A cached
+# version matching If-None-Match is answered with 304 without computing anything.
+def cached_response(key, compute, mimetype='application/json'):
+    found, entry = response_cache.get(key)
+    if not found:
+        entry = compute()
+        if entry is None:
+            return None
+        response_cache.set(key, entry)
+    version, body = entry
+    return not_modified(version) or tagged(Response(body, mimetype=mimetype), version)
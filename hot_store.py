@@ -0,0 +1,293 @@
+import datetime
+import os
+import threading
+import time
+
+import numpy as np
+from sqlalchemy import func, select
+from aggregation import BucketAggregate, bucket_bounds
+from models import ENUM_COLUMNS, ENUM_VALUES, NUMERIC_COLUMNS, WeatherData
+from database import Session
+from etags import load_data_version
+from serializers import READING_FIELDS
+
+# Readings of the last HOT_WINDOW_DAYS before the latest one are kept in memory
+HOT_WINDOW_DAYS = float(os.environ.get('HOT_WINDOW_DAYS', 15))
+
+# The store is reloaded from the database this often, to pick up ingests run by other processes
+HOT_STORE_REFRESH_SECONDS = float(os.environ.get('HOT_STORE_REFRESH_SECONDS', 300))
+
+# Set to false to answer every read from the database
+HOT_STORE_ENABLED = os.environ.get('HOT_STORE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+READING_INTERVAL = datetime.timedelta(minutes=5)
+
+_ENUM_CODES = {column: {value: code for code, value in enumerate(ENUM_VALUES[column])} for column in ENUM_COLUMNS}
+_NUMERIC_POSITIONS = {column: i for i, column in enumerate(NUMERIC_COLUMNS)}
+_ENUM_POSITIONS = {column: i for i, column in enumerate(ENUM_COLUMNS)}
+_ENUM_LOOKUPS = {column: np.array(ENUM_VALUES[column] + [None], dtype=object) for column in ENUM_COLUMNS}
+
+
+# Columnar copy of the most recent readings: one datetime64 column for the timestamps, a float
+# matrix for the numeric columns (NaN for missing values) and an int8 matrix of enum value codes
+# (-1 for missing values). Rows are kept in timestamp order so every time range is one slice.
+# The arrays hold twice the window, old rows are dropped in one move whenever they fill up.
+class HotStore:
+    def __init__(self, window=datetime.timedelta(days=HOT_WINDOW_DAYS), refresh_seconds=HOT_STORE_REFRESH_SECONDS,
+                 enabled=HOT_STORE_ENABLED):
+        self.window = window
+        self.refresh_seconds = refresh_seconds
+        self.enabled = enabled
+        self._lock = threading.RLock()
+        self._loaded = threading.Condition(self._lock)
+        self._allocate(2 * int(window / READING_INTERVAL))
+        # Every stored reading at or after this instant is in the store, None until warmed
+        self._covered_from = None
+        self._warmed_at = None
+        self._dirty = True
+        self._loading = False
+        # etags.load_data_version of the stored readings
+        self._version = None
+
+    def _allocate(self, capacity):
+        self._capacity = capacity
+        self._size = 0
+        self._times = np.empty(capacity, dtype='datetime64[us]')
+        self._numeric = np.empty((capacity, len(NUMERIC_COLUMNS)), dtype=np.float64)
+        self._codes = np.empty((capacity, len(ENUM_COLUMNS)), dtype=np.int8)
+
+    def _encode(self, rows):
+        times = np.array([row['timestamp'] for row in rows], dtype='datetime64[us]')
+        numeric = np.array([[row[column] for column in NUMERIC_COLUMNS] for row in rows],
+                           dtype=np.float64).reshape(len(rows), len(NUMERIC_COLUMNS))
+        codes = np.array([[_ENUM_CODES[column].get(row[column], -1) for column in ENUM_COLUMNS] for row in rows],
+                         dtype=np.int8).reshape(len(rows), len(ENUM_COLUMNS))
+        return times, numeric, codes
+
+    # Drop the rows older than the window before latest, then append the given rows after the rest
+    def _store(self, times, numeric, codes, latest):
+        cut = np.datetime64(latest - self.window, 'us')
+        keep_from = int(np.searchsorted(self._times[:self._size], cut))
+        kept = self._size - keep_from
+        if kept + len(times) > self._capacity:
+            old = (self._times[keep_from:self._size].copy(), self._numeric[keep_from:self._size].copy(),
+                   self._codes[keep_from:self._size].copy())
+            self._allocate(max(self._capacity, 2 * (kept + len(times))))
+            self._times[:kept], self._numeric[:kept], self._codes[:kept] = old
+        elif keep_from:
+            self._times[:kept] = self._times[keep_from:self._size]
+            self._numeric[:kept] = self._numeric[keep_from:self._size]
+            self._codes[:kept] = self._codes[keep_from:self._size]
+        self._size = kept + len(times)
+        self._times[kept:self._size] = times
+        self._numeric[kept:self._size] = numeric
+        self._codes[kept:self._size] = codes
+        if self._covered_from is None or self._covered_from < latest - self.window:
+            self._covered_from = latest - self.window
+
+    # Reload the window before the latest stored reading from the database
+    def warm(self):
+        session = Session()
+        try:
+            # Read before the rows, so the rows are never older than the version
+            version = load_data_version(session)
+            latest = session.execute(select(func.max(WeatherData.timestamp))).scalar()
+            rows = []
+            if latest is not None:
+                columns = [WeatherData.timestamp] + [getattr(WeatherData, column)
+                                                     for column in NUMERIC_COLUMNS + ENUM_COLUMNS]
+                rows = session.execute(select(*columns)
+                                       .where(WeatherData.timestamp >= latest - self.window)
+                                       .order_by(WeatherData.timestamp.asc())).mappings().all()
+        finally:
+            session.close()
+        encoded = self._encode(rows) if rows else None
+        # Only the swap holds the lock, reads keep using the current rows while the new ones load
+        with self._lock:
+            self._size = 0
+            self._covered_from = None
+            if encoded:
+                self._store(*encoded, latest)
+            self._version = version
+            self._warmed_at = time.monotonic()
+            self._dirty = False
+
+    # Called by ingest after a commit with the rows written and the data versions its transaction saw
+    # before and after writing them. Readings newer than everything stored are appended, anything
+    # else may have replaced a stored reading and marks the store for a reload, as does a version
+    # before that is not the store's: another writer committed rows the store does not hold.
+    def append(self, rows, version_before, version_after):
+        with self._lock:
+            if self._dirty or not self.enabled:
+                return
+            # Warmed while the table was empty, the next read loads what has been written since
+            if self._covered_from is None:
+                self._dirty = True
+                return
+            if version_before != self._version:
+                self._dirty = True
+                return
+            # Older readings are outside the window and leave the store as it is
+            rows = sorted((row for row in rows if row['timestamp'] >= self._covered_from),
+                          key=lambda row: row['timestamp'])
+            if not rows:
+                self._version = version_after
+                return
+            times, numeric, codes = self._encode(rows)
+            last = self._times[self._size - 1] if self._size else None
+            # Compared element-wise, comparing a timedelta64 array with 0 is an error on older NumPy
+            if (last is not None and times[0] <= last) or not (times[1:] > times[:-1]).all():
+                self._dirty = True
+                return
+            self._store(times, numeric, codes, rows[-1]['timestamp'])
+            self._version = version_after
+
+    # Reload from the database on the next read
+    def invalidate(self):
+        with self._lock:
+            self._dirty = True
+
+    # Reload when ingest left the store dirty or the last load is older than refresh_seconds. Runs
+    # without the lock and one reload at a time: meanwhile other reads keep using the current rows,
+    # or fall back to SQL while the store is dirty.
+    def _ensure_fresh(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            expired = self._warmed_at is None or time.monotonic() - self._warmed_at > self.refresh_seconds
+            reload = (self._dirty or expired) and not self._loading
+            if reload:
+                self._loading = True
+        if not reload:
+            return
+        try:
+            self.warm()
+        except Exception as e:
+            print(f'Error occurred while warming the hot store: {str(e)}')
+        finally:
+            with self._lock:
+                self._loading = False
+                self._loaded.notify_all()
+
+    # Load the store in a background thread, so a new process serves requests while it loads
+    def warm_in_background(self):
+        thread = threading.Thread(target=self._ensure_fresh, name='hot-store-warm', daemon=True)
+        thread.start()
+        return thread
+
+    # Block until a reload running in another thread is done
+    def wait_loaded(self):
+        with self._lock:
+            self._loaded.wait_for(lambda: not self._loading)
+
+    # Whether the stored rows can answer reads, called with the lock held. When not, the caller falls back to SQL.
+    def _usable(self):
+        return self.enabled and not self._dirty and self._size > 0
+
+    # Stored rows at the given positions as tuples in READING_FIELDS order, converted column by column
+    def _readings(self, indexes):
+        columns = {'timestamp': self._times[indexes].tolist()}
+        numeric = self._numeric[indexes]
+        values = numeric.astype(object)
+        values[np.isnan(numeric)] = None
+        for column, position in _NUMERIC_POSITIONS.items():
+            columns[column] = values[:, position].tolist()
+        columns['wind_direction_degrees'] = [None if value is None else int(value)
+                                             for value in columns['wind_direction_degrees']]
+        for column, position in _ENUM_POSITIONS.items():
+            # Code -1 picks the trailing None
+            columns[column] = _ENUM_LOOKUPS[column][self._codes[indexes, position]].tolist()
+        return list(zip(*(columns[field] for field in READING_FIELDS)))
+
+    # Data version of the stored readings, None when the store cannot be used
+    def data_version(self):
+        self._ensure_fresh()
+        with self._lock:
+            if not self._usable():
+                return None
+            return self._version
+
+    def latest_timestamp(self):
+        self._ensure_fresh()
+        with self._lock:
+            if not self._usable():
+                return None
+            return self._times[self._size - 1].item()
+
+    # Latest reading as a tuple in READING_FIELDS order, None to fall back to SQL
+    def latest(self):
+        self._ensure_fresh()
+        with self._lock:
+            if not self._usable():
+                return None
+            return self._readings([self._size - 1])[0]
+
+    def _slice(self, start, end):
+        times = self._times[:self._size]
+        return (int(np.searchsorted(times, np.datetime64(start, 'us'), side='left')),
+                int(np.searchsorted(times, np.datetime64(end, 'us'), side='right')))
+
+    # Readings of [start, end] whose offset from start is a whole number of steps, as tuples in
+    # READING_FIELDS order. None when the range is not held in memory.
+    def readings(self, start, end, step):
+        self._ensure_fresh()
+        with self._lock:
+            if not self._usable() or start < self._covered_from:
+                return None
+            lo, hi = self._slice(start, end)
+            offsets = self._times[lo:hi] - np.datetime64(start, 'us')
+            selected = np.flatnonzero(offsets % np.timedelta64(step) == np.timedelta64(0, 'us')) + lo
+            return self._readings(selected)
+
+    # Same result as aggregation.aggregate_buckets with include_end, computed on the stored
+    # columns. None when the range is not held in memory.
+    def aggregate_buckets(self, start, end, width):
+        self._ensure_fresh()
+        with self._lock:
+            if not self._usable() or start < self._covered_from:
+                return None
+            # Copies, appends may move the stored rows once the lock is released
+            lo, hi = self._slice(start, end)
+            times = self._times[lo:hi].copy()
+            numeric = self._numeric[lo:hi].copy()
+            codes = self._codes[lo:hi].copy()
+
+        bounds = bucket_bounds(start, end, width)
+        bucket_count = len(bounds)
+        buckets = np.minimum((times - np.datetime64(start, 'us')) // np.timedelta64(width), bucket_count - 1)
+        counts = np.bincount(buckets, minlength=bucket_count)
+        starts = np.searchsorted(buckets, np.arange(bucket_count))
+        non_empty = counts > 0
+        sums = np.zeros((bucket_count, len(NUMERIC_COLUMNS)))
+        mins = np.full((bucket_count, len(NUMERIC_COLUMNS)), np.nan)
+        maxs = np.full((bucket_count, len(NUMERIC_COLUMNS)), np.nan)
+        if non_empty.any():
+            for position in range(len(NUMERIC_COLUMNS)):
+                values = numeric[:, position]
+                sums[:, position] = np.bincount(buckets, weights=np.nan_to_num(values), minlength=bucket_count)
+                mins[non_empty, position] = np.fmin.reduceat(values, starts[non_empty])
+                maxs[non_empty, position] = np.fmax.reduceat(values, starts[non_empty])
+        histograms = {}
+        for column, position in _ENUM_POSITIONS.items():
+            value_count = len(ENUM_VALUES[column])
+            column_codes = codes[:, position].astype(np.int64)
+            present = column_codes >= 0
+            histograms[column] = np.bincount(buckets[present] * value_count + column_codes[present],
+                                             minlength=bucket_count * value_count).reshape(bucket_count, value_count)
+
+        result = []
+        for i, (bucket_start, bucket_end) in enumerate(bounds):
+            bucket = BucketAggregate(bucket_start, bucket_end)
+            bucket.merge(int(counts[i]),
+                         {column: sums[i, position].item() for column, position in _NUMERIC_POSITIONS.items()},
+                         {column: None if np.isnan(mins[i, position]) else mins[i, position].item()
+                          for column, position in _NUMERIC_POSITIONS.items()},
+                         {column: None if np.isnan(maxs[i, position]) else maxs[i, position].item()
+                          for column, position in _NUMERIC_POSITIONS.items()},
+                         {column: dict(zip(ENUM_VALUES[column], histograms[column][i].tolist()))
+                          for column in ENUM_COLUMNS})
+            result.append(bucket)
+        return result
+
+
+hot_store = HotStore()
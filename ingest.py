@@ -0,0 +1,283 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+from models import IngestManifest, WeatherData
+from database import Session, upsert_statement
+from cache import response_cache
+from rollups import lock_rollup_days, refresh_rollups_for, release_rollup_days
+from metrics import metrics
+from broadcast import latest_readings
+from hot_store import hot_store
+from etags import load_data_version
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Position of each weather_data column inside the 'rows' list of a climate computer dump
+ROW_INDEXES = [
+    ('external_temperature_c', 1),
+    ('wind_speed_unmuted_m_s', 2),
+    ('wind_speed_m_s', 3),
+    ('wind_direction_degrees', 4),
+    ('wind_direction_compass', 5),
+    ('radiation_intensity_unmuted_w_m2', 6),
+    ('radiation_intensity_w_m2', 7),
+    ('standard_radiation_intensity_w_m2', 8),
+    ('radiation_sum_j_cm2', 9),
+    ('radiation_from_plant_w_m2', 10),
+    ('precipitation', 11),
+    ('relative_humidity_perc', 12),
+    ('moisture_deficit_g_kg', 13),
+    ('moisture_deficit_g_m3', 14),
+    ('dew_point_temperature_c', 15),
+    ('abs_humidity_g_kg', 16),
+    ('enthalpy_kj_kg', 17),
+    ('enthalpy_kj_m3', 18),
+    ('atmospheric_pressure_hpa', 19),
+    ('status_meteo_station', 20),
+    ('status_meteo_station_communication', 21),
+]
+
+# Columns that arrive wrapped as {'type': 'hortimax.synopta.enum', 'key': ..., 'value': ...}
+ENUM_COLUMNS = {'wind_direction_compass', 'status_meteo_station', 'status_meteo_station_communication'}
+
+# Order of the values in the row tuples produced by parse_weather_row
+ROW_COLUMNS = [column for column, index in ROW_INDEXES] + ['timestamp']
+
+# Number of parser processes used by bulk ingest, 1 parses on the request thread
+DEFAULT_WORKERS = int(os.environ.get('INGEST_WORKERS', os.cpu_count() or 1))
+
+# Archive members handed to a parser process per task, also the size of the manifest lookups
+PARSE_CHUNK_SIZE = 200
+
+# Reading timestamp of a raw dump, found without decoding the JSON
+TS_PATTERN = re.compile(rb'"ts"\s*:\s*"([^"]+)"')
+
+
+# Map one decoded climate computer dump to a tuple of values in ROW_COLUMNS order
+def parse_weather_row(data):
+    rows = data['rows']
+    values = [rows[index][1]['value'] if column in ENUM_COLUMNS else rows[index][1]
+              for column, index in ROW_INDEXES]
+    # remove timezone offset and parse timestamp
+    values.append(datetime.datetime.strptime(data['ts'][:-6], '%Y-%m-%dT%H:%M:%S'))
+    return tuple(values)
+
+
+# Map one decoded climate computer dump to the keyword arguments of a WeatherData row
+def parse_weather_data(data):
+    return dict(zip(ROW_COLUMNS, parse_weather_row(data)))
+
+
+# Parse a chunk of (name, content hash, raw bytes) archive members. Runs inside the parser
+# processes, so it only does CPU work and returns plain tuples that are cheap to pickle.
+def parse_members(chunk):
+    rows, failures = [], []
+    for name, content_hash, raw in chunk:
+        try:
+            rows.append((name, content_hash, parse_weather_row(json.loads(raw))))
+        except Exception as e:
+            failures.append({'file': name, 'error': str(e)})
+    return rows, failures
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Tell the read side about committed rows: drop the cached bodies, wake the stream clients and
+# append to the in-memory store. The rows are already durable, so a failing update is logged and
+# leaves the in-memory store to be reloaded from the database instead of failing the ingest.
+def publish_committed(rows, version_before, version_after):
+    updates = [('response cache', response_cache.clear),
+               ('latest reading broadcast', lambda: latest_readings.committed(max(row['timestamp'] for row in rows))),
+               ('hot store', lambda: hot_store.append(rows, version_before, version_after))]
+    for name, update in updates:
+        try:
+            update()
+        except Exception as e:
+            print(f"Error occurred while updating the {name} after a commit: {str(e)}")
+            hot_store.invalidate()
+
+
+# Single consumer of parsed rows, writes them in batches of batch_size rows with one
+# executemany upsert and one transaction per batch. Readings already stored are replaced, and
+# the manifest entries of the batch's files and the rollups of the days it touches are
+# written in the same transaction, which holds the rollup locks of those days.
+class BatchWriter:
+    def __init__(self, batch_size, report):
+        self.batch_size = batch_size
+        self.report = report
+        self.rows = []
+        self.sources = []
+
+    def add(self, parsed, failures):
+        for error in failures:
+            print(f"Error occurred while processing file {error['file']}: {error['error']}")
+        self.report['failed_files'].extend(failures)
+        for name, content_hash, row in parsed:
+            self.rows.append(dict(zip(ROW_COLUMNS, row)))
+            self.sources.append((name, content_hash))
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows, sources = self.rows, self.sources
+        self.rows, self.sources = [], []
+        started = time.perf_counter()
+        ingested_at = datetime.datetime.now()
+        manifest = [{'source_name': name[:255], 'content_hash': content_hash, 'reading_timestamp': row['timestamp'],
+                     'ingested_at': ingested_at} for (name, content_hash), row in zip(sources, rows)]
+        session = Session()
+        try:
+            lock_rollup_days(session, [row['timestamp'] for row in rows])
+            dialect = session.get_bind().dialect.name
+            # Versions around the writes, for the in-memory store to check that it saw every earlier write
+            version_before = load_data_version(session)
+            session.execute(upsert_statement(WeatherData.__table__, ['timestamp'], dialect), rows)
+            session.execute(upsert_statement(IngestManifest.__table__, ['content_hash'], dialect), manifest)
+            refresh_rollups_for(session, [row['timestamp'] for row in rows])
+            version_after = load_data_version(session)
+            session.commit()
+        except (SQLAlchemyError, TimeoutError) as e:
+            session.rollback()
+            print(f"Error occurred while inserting batch of {len(rows)} rows: {str(e)}")
+            self.report['failed_batches'] += 1
+            self.report['failed_files'].extend({'file': name, 'error': str(e)} for name, content_hash in sources)
+            return
+        finally:
+            release_rollup_days(session)
+            session.close()
+        self.report['rows_inserted'] += len(rows)
+        self.report['batches'] += 1
+        metrics.record_ingest(len(rows), time.perf_counter() - started)
+        publish_committed(rows, version_before, version_after)
+
+
+# Yield (name, raw bytes) for every JSON reading in the archive. Members are read
+# straight from the ZIP, nothing is extracted to disk.
+def iter_archive_members(zip_ref):
+    for info in zip_ref.infolist():
+        name = info.filename
+        if info.is_dir() or not name.endswith('.json'):
+            continue
+        # Skip the resource forks macOS adds when zipping a folder
+        if '__MACOSX' in name.split('/') or os.path.basename(name).startswith('._'):
+            continue
+        yield name, zip_ref.read(info)
+
+
+# Yield (name, raw bytes) for every reading of an NDJSON stream, one line at a time so the
+# body of a push request is never held in memory as a whole
+def iter_ndjson_members(stream):
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if line:
+            yield f'request line {number}', line
+
+
+def new_report(workers):
+    return {'files': 0, 'skipped_files': 0, 'rows_inserted': 0, 'batches': 0, 'failed_batches': 0,
+            'failed_files': [], 'workers': workers}
+
+
+# Timestamp of the latest stored reading in the format of the dumps' 'ts' field, without the offset
+def stored_watermark():
+    session = Session()
+    try:
+        latest = session.execute(select(func.max(WeatherData.timestamp))).scalar()
+    finally:
+        session.close()
+    return latest.strftime('%Y-%m-%dT%H:%M:%S') if latest is not None else None
+
+
+# Content hashes among the given ones that are already recorded in the ingest manifest
+def known_hashes(content_hashes):
+    session = Session()
+    try:
+        return set(session.execute(select(IngestManifest.content_hash)
+                                   .where(IngestManifest.content_hash.in_(content_hashes))).scalars())
+    finally:
+        session.close()
+
+
+# Group (name, raw bytes) members into chunks of (name, content hash, raw bytes) left to parse.
+# Files recorded in the ingest manifest, repeated within the run or, with a watermark, holding
+# a reading not newer than it are skipped without being decoded.
+def unseen_chunks(members, report, watermark=None):
+    seen = set()
+    for chunk in _chunked(members, PARSE_CHUNK_SIZE):
+        report['files'] += len(chunk)
+        hashed = []
+        for name, raw in chunk:
+            if watermark is not None:
+                match = TS_PATTERN.search(raw)
+                if match is not None and match.group(1)[:19].decode() <= watermark:
+                    continue
+            content_hash = hashlib.sha256(raw).hexdigest()
+            if content_hash not in seen:
+                seen.add(content_hash)
+                hashed.append((name, content_hash, raw))
+        known = known_hashes([content_hash for name, content_hash, raw in hashed]) if hashed else set()
+        unseen = [member for member in hashed if member[1] not in known]
+        report['skipped_files'] += len(chunk) - len(unseen)
+        if unseen:
+            yield unseen
+
+
+# Parse the given (name, raw bytes) members and insert their readings through a single
+# BatchWriter. With workers > 1 the JSON decoding and timestamp parsing run in a process
+# pool while the calling thread writes the previous batches. Files already ingested are
+# skipped, with only_newer so are the readings up to the latest stored timestamp. Progress
+# is counted in report as it happens, so another thread can watch a running ingest.
+def bulk_insert_weather_data(members, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, report=None,
+                             only_newer=False):
+    if report is None:
+        report = new_report(workers)
+    started = time.perf_counter()
+    writer = BatchWriter(batch_size, report)
+
+    chunks = unseen_chunks(members, report, stored_watermark() if only_newer else None)
+    if workers <= 1:
+        for chunk in chunks:
+            writer.add(*parse_members(chunk))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Keep a bounded number of chunks in flight so memory stays flat on big archives
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(parse_members, chunk))
+                if len(pending) >= workers * 2:
+                    writer.add(*pending.popleft().result())
+            while pending:
+                writer.add(*pending.popleft().result())
+    writer.flush()
+
+    elapsed = time.perf_counter() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['rows_inserted'] / elapsed, 1) if elapsed > 0 else None
+    return report
+
+
+def ingest_archive(archive_path, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, report=None,
+                   only_newer=False):
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        return bulk_insert_weather_data(iter_archive_members(zip_ref), batch_size=batch_size, workers=workers,
+                                        report=report, only_newer=only_newer)
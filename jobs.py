@@ -0,0 +1,84 @@
+import datetime
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from database import Session
+
+# Background threads running ingest jobs, so big archives do not hold a request worker
+INGEST_JOB_WORKERS = int(os.environ.get('INGEST_JOB_WORKERS', 2))
+
+# Finished jobs kept for status polling, the oldest are forgotten first
+MAX_FINISHED_JOBS = int(os.environ.get('MAX_FINISHED_INGEST_JOBS', 100))
+
+
+class IngestJob:
+    def __init__(self, source, report):
+        self.id = uuid.uuid4().hex
+        self.source = source
+        self.status = 'queued'
+        self.report = report
+        self.error = None
+        self.created_at = datetime.datetime.now()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        report = dict(self.report, failed_files=list(self.report['failed_files']))
+        if self.started is not None:
+            elapsed = (self.finished or time.perf_counter()) - self.started
+            report['seconds'] = round(elapsed, 3)
+            report['rows_per_second'] = round(report['rows_inserted'] / elapsed, 1) if elapsed > 0 else None
+        return {'job_id': self.id, 'source': self.source, 'status': self.status, 'error': self.error,
+                'created_at': str(self.created_at), **report}
+
+
+class IngestJobQueue:
+    def __init__(self, max_workers=INGEST_JOB_WORKERS, max_finished=MAX_FINISHED_JOBS):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Queue run(report) in the background. run fills the report dict as it goes.
+    def submit(self, source, report, run):
+        job = IngestJob(source, report)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self._executor.submit(self._run, job, run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job, run):
+        job.status = 'running'
+        job.started = time.perf_counter()
+        try:
+            run(job.report)
+            job.status = 'completed_with_errors' if job.report['failed_files'] else 'succeeded'
+        except Exception as e:
+            print(f'Error occurred while running ingest job {job.id} for {job.source}: {str(e)}')
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            job.finished = time.perf_counter()
+            # Give the thread's scoped session back to the pool
+            Session.remove()
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+
+ingest_jobs = IngestJobQueue()
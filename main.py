@@ -1,55 +1,58 @@
 import datetime
-import zipfile
 import json
 import os
-import shutil
 
-from flask import Flask, jsonify, request
-from sqlalchemy import func
-from sqlalchemy.exc import SQLAlchemyError
+from flask import Flask, Response, jsonify, request, stream_with_context, url_for
+from sqlalchemy import DateTime, func, literal, select
 from models import WeatherData
-from database import Session
+from database import Session, engine
+from cache import response_cache
+from serializers import READING_COLUMNS, READING_FIELDS, csv_lines, dumps, ndjson_lines, serialize_averages, \
+    serialize_reading
+from aggregation import BUCKET_WIDTHS, seconds_between
+from analytics import DEFAULT_PERCENTILES, window_analytics
+from rollups import rollup_aggregate_buckets
+from ingest import DEFAULT_BATCH_SIZE, DEFAULT_WORKERS, bulk_insert_weather_data, ingest_archive, \
+    iter_ndjson_members, new_report
+from jobs import ingest_jobs
+from broadcast import latest_readings
+from hot_store import hot_store
+from etags import cached_response, load_data_version, not_modified, tagged
+from compression import init_compression
+from metrics import init_metrics, metrics
 
 app = Flask(__name__)
+# Statement counts, DB time and latency of every request, served on /metrics
+init_metrics(app, engine)
+# gzip/brotli for clients that accept it, streamed responses included
+init_compression(app)
+# Load the recent readings as soon as a process imports the app, under gunicorn or waitress as well
+hot_store.warm_in_background()
 
+# Content types of the /api/export formats
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# Position of the timestamp in a reading selected as READING_COLUMNS
+TIMESTAMP_POSITION = READING_FIELDS.index('timestamp')
+
+# Content types accepted by /api/readings for streamed bodies
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+
+# Seconds between the comment lines that keep idle /api/weather-latest/stream connections open
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+
+# Longest window /api/analytics computes with ?days=
+ANALYTICS_MAX_DAYS = int(os.environ.get('ANALYTICS_MAX_DAYS', 3660))
+
+# Rows fetched per query and streamed chunk of /api/export
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+
+# Every handler shares the request's scoped session, it is given back to the pool once the request ends
+@app.teardown_appcontext
+def remove_session(exception=None):
+    Session.remove()
 
-def insert_weather_data(json_file):
-    with open(json_file) as f:
-        data = json.load(f)
-    r = []
-    weather_data = {'external_temperature_c': data['rows'][1][1], 'wind_speed_unmuted_m_s': data['rows'][2][1],
-                    'wind_speed_m_s': data['rows'][3][1], 'wind_direction_degrees': data['rows'][4][1],
-                    'wind_direction_compass': data['rows'][5][1]['value'],
-                    'radiation_intensity_unmuted_w_m2': data['rows'][6][1],
-                    'radiation_intensity_w_m2': data['rows'][7][1],
-                    'standard_radiation_intensity_w_m2': data['rows'][8][1], 'radiation_sum_j_cm2': data['rows'][9][1],
-                    'radiation_from_plant_w_m2': data['rows'][10][1], 'precipitation': data['rows'][11][1],
-                    'relative_humidity_perc': data['rows'][12][1], 'moisture_deficit_g_kg': data['rows'][13][1],
-                    'moisture_deficit_g_m3': data['rows'][14][1], 'dew_point_temperature_c': data['rows'][15][1],
-                    'abs_humidity_g_kg': data['rows'][16][1], 'enthalpy_kj_kg': data['rows'][17][1],
-                    'enthalpy_kj_m3': data['rows'][18][1], 'atmospheric_pressure_hpa': data['rows'][19][1],
-                    'status_meteo_station': data['rows'][20][1]['value'],
-                    'status_meteo_station_communication': data['rows'][21][1]['value']}
-
-    timestamp_str = data['ts']
-    timestamp_obj = datetime.datetime.strptime(timestamp_str[:-6],
-                                               '%Y-%m-%dT%H:%M:%S')  # remove timezone offset and parse timestamp
-    formatted_timestamp_str = timestamp_obj.strftime('%Y-%m-%d %H:%M:%S')  # format timestamp
-    weather_data['timestamp'] = formatted_timestamp_str
-    r.append(weather_data)
-    json_data = json.dumps(data)
-    try:
-        session = Session()
-        new_data = WeatherData(**weather_data)
-        session.add(new_data)
-        session.commit()
-    except SQLAlchemyError as e:
-        session.rollback()
-        print(f"Error occurred while inserting data: {str(e)}")
-        raise
-    finally:
-        session.close()
-    return json_data
 
 #An API endpoint to consume the raw data from the greenhouse climate computer
 @app.route('/consume-raw-data', methods=['POST'])
@@ -61,299 +64,284 @@ def consume_raw_data():
     if not os.path.exists(folder_path):
         return jsonify({'message': f'Folder path {folder_path} does not exist.'}), 400
 
+    batch_size = request.json.get('batch_size', DEFAULT_BATCH_SIZE)
+    if not isinstance(batch_size, int) or batch_size < 1:
+        return jsonify({'message': 'batch_size must be a positive integer.'}), 400
+
+    workers = request.json.get('workers', DEFAULT_WORKERS)
+    if not isinstance(workers, int) or workers < 1:
+        return jsonify({'message': 'workers must be a positive integer.'}), 400
+
+    # Skip the readings up to the latest stored timestamp without decoding them, for cumulative dumps
+    only_newer = request.json.get('only_newer', False)
+    if not isinstance(only_newer, bool):
+        return jsonify({'message': 'only_newer must be true or false.'}), 400
+
+    # The archive is ingested by a background job, poll the returned status_url for progress
+    job = ingest_jobs.submit(folder_path, new_report(workers),
+                             lambda report: ingest_archive(folder_path, batch_size=batch_size, workers=workers,
+                                                           report=report, only_newer=only_newer))
+    return jsonify({'message': 'Raw data ingest queued.', 'job_id': job.id,
+                    'status_url': url_for('ingest_job_status', job_id=job.id)}), 202
+
+
+# Push one or many readings in the climate computer's ts/rows shape, as a JSON array or object
+# or as an NDJSON body that is parsed line by line while it arrives
+@app.route('/api/readings', methods=['POST'])
+def push_readings():
+    try:
+        batch_size = int(request.args.get('batch_size', DEFAULT_BATCH_SIZE))
+    except ValueError:
+        batch_size = 0
+    if batch_size < 1:
+        return jsonify({'message': 'batch_size must be a positive integer.'}), 400
+
+    if request.mimetype in NDJSON_MIMETYPES:
+        members = iter_ndjson_members(request.stream)
+    elif request.mimetype == 'application/json':
+        readings = request.get_json(silent=True)
+        if isinstance(readings, dict):
+            readings = [readings]
+        if not isinstance(readings, list):
+            return jsonify({'message': 'Please send a reading or an array of readings.'}), 400
+        members = ((f'request item {number}', json.dumps(reading).encode())
+                   for number, reading in enumerate(readings, start=1))
+    else:
+        return jsonify({'message': 'Content-Type must be application/json or application/x-ndjson.'}), 415
+
     try:
-        extract_folder_path = os.path.join(os.getcwd(), "dumps")
-        files_path = os.path.join(extract_folder_path, 'may')
-        with zipfile.ZipFile(folder_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_folder_path)
-
-        # Remove the __MACOSX folder from the extract directory
-        mac_folder_path = os.path.join(extract_folder_path, '__MACOSX')
-        if os.path.exists(mac_folder_path):
-            shutil.rmtree(mac_folder_path)
-
-        response = ''
-        for root, dirs, files in os.walk(files_path):
-            for file in files:
-                if file.endswith('.json'):
-                    json_file = os.path.join(root, file)
-                    try:
-                        response += insert_weather_data(json_file)
-                    except Exception as e:
-                        error_message = f'Error occurred while processing file {json_file}: {str(e)}\n'
-                        print(error_message)
-                        response += error_message
-
-        shutil.rmtree(files_path)
-
-        return jsonify({'message': 'Raw data consumed successfully.'}), 200
+        report = bulk_insert_weather_data(members, batch_size=batch_size, workers=1)
     except Exception as e:
-        error_message = f'Error occurred while processing folder {folder_path}: {str(e)}\n'
-        print(error_message)
-        return jsonify({'message': error_message}), 500
+        return jsonify({'message': 'An error occurred while ingesting the readings.', 'error': str(e)}), 500
+    if report['failed_files']:
+        return jsonify({'message': 'Some readings could not be ingested.', **report}), 422
+    return jsonify({'message': 'Readings ingested.', **report})
+
+
+# Progress of an ingest job: files processed, rows inserted, failures and throughput
+@app.route('/api/ingest-jobs/<job_id>', methods=['GET'])
+def ingest_job_status(job_id):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({'message': f'Ingest job {job_id} not found.'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/ingest-jobs', methods=['GET'])
+def ingest_job_list():
+    return jsonify([job.to_dict() for job in ingest_jobs.jobs()])
 
 
 # Expose the latest weather conditions (i.e. show what's happening now)
 @app.route('/api/weather-latest_modifications', methods=['GET'])
 def weather_modifications():
     try:
-        session = Session()
-        latest_data = session.query(WeatherData).order_by(WeatherData.timestamp.desc()).first()
-        session.close()
-        if latest_data is None:
+        response = cached_response(('weather-latest',), load_latest_weather)
+        if response is None:
             return jsonify({'message': 'No data available.'}), 404
-        data = {
-            'timestamp': str(latest_data.timestamp),
-            'external_temperature_c': latest_data.external_temperature_c,
-            'wind_speed_unmuted_m_s': latest_data.wind_speed_unmuted_m_s,
-            'wind_speed_m_s': latest_data.wind_speed_m_s,
-            'wind_direction_degrees': latest_data.wind_direction_degrees,
-            'wind_direction_compass': {
-                'type': 'hortimax.synopta.enum',
-                'key': 8787,
-                'value': latest_data.wind_direction_compass
-            },
-            'radiation_intensity_unmuted_w_m2': latest_data.radiation_intensity_unmuted_w_m2,
-            'radiation_intensity_w_m2': latest_data.radiation_intensity_w_m2,
-            'standard_radiation_intensity_w_m2': latest_data.standard_radiation_intensity_w_m2,
-            'radiation_sum_j_cm2': latest_data.radiation_sum_j_cm2,
-            'radiation_from_plant_w_m2': latest_data.radiation_from_plant_w_m2,
-            'precipitation': latest_data.precipitation,
-            'relative_humidity_perc': latest_data.relative_humidity_perc,
-            'moisture_deficit_g_kg': latest_data.moisture_deficit_g_kg,
-            'moisture_deficit_g_m3': latest_data.moisture_deficit_g_m3,
-            'dew_point_temperature_c': latest_data.dew_point_temperature_c,
-            'abs_humidity_g_kg': latest_data.abs_humidity_g_kg,
-            'enthalpy_kj_kg': latest_data.enthalpy_kj_kg,
-            'enthalpy_kj_m3': latest_data.enthalpy_kj_m3,
-            'atmospheric_pressure_hpa': latest_data.atmospheric_pressure_hpa,
-            'status_meteo_station': {
-                'type': 'hortimax.synopta.enum',
-                'key': 8789,
-                'value': latest_data.status_meteo_station
-            },
-            'status_meteo_station_communication': {
-                'type': 'hortimax.synopta.enum',
-                'key': 8796,
-                'value': latest_data.status_meteo_station_communication
-            },
-        }
-        return json.dumps(data)
+        return response
+    except Exception as e:
+        return jsonify({'message': 'An error occurred while fetching the latest weather data.', 'error': str(e)}), 500
+
+
+def load_latest_weather():
+    session = Session()
+    version = current_data_version(session)
+    if version is None:
+        return None
+    latest_data = hot_store.latest()
+    if latest_data is None:
+        latest_data = session.query(*READING_COLUMNS).order_by(WeatherData.timestamp.desc()).first()
+    return version, dumps(serialize_reading(latest_data))
+
+
+# Version of the data the next reads see: the in-memory store's when it can answer them, the database's otherwise
+def current_data_version(session):
+    return hot_store.data_version() or load_data_version(session)
+
+
+# Server-Sent Events stream of the latest reading, pushed once when ingest commits a newer one.
+# Clients resume with the Last-Event-ID header or ?since=<ISO timestamp> and only get readings after it.
+@app.route('/api/weather-latest/stream', methods=['GET'])
+def weather_latest_stream():
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        after = datetime.datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return jsonify({'message': 'since must be an ISO 8601 timestamp'}), 400
+    # Readings are stored in the climate computer's local time with the offset dropped, the same goes for since
+    if after is not None:
+        after = after.replace(tzinfo=None)
+    try:
+        latest_readings.prime()
     except Exception as e:
         return jsonify({'message': 'An error occurred while fetching the latest weather data.', 'error': str(e)}), 500
 
+    def generate(after):
+        yield f'retry: {int(SSE_HEARTBEAT_SECONDS * 1000)}\n\n'.encode()
+        while True:
+            reading = latest_readings.wait(after, SSE_HEARTBEAT_SECONDS)
+            if reading is None:
+                yield b': heartbeat\n\n'
+                # Readings ingested by other worker processes do not wake this one
+                latest_readings.refresh(SSE_HEARTBEAT_SECONDS)
+                continue
+            after, body = reading
+            yield f'id: {after.isoformat()}\nevent: reading\ndata: '.encode() + body + b'\n\n'
+
+    return Response(generate(after), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
 # Expose the development of the weather parameters over the last 24h in 15 min increments
 @app.route('/api/last_day_weather', methods=['GET'])
 def get_weather_data():
+    interval = request.json.get('interval')
+    if interval is None or interval == '':
+        return jsonify({'message': 'Interval value is missing'}), 400
+    if not isinstance(interval, int) or interval < 5:
+        return jsonify({'message': 'The interval must be a whole number of minutes of at least 5'}), 400
+    if interval % 5 != 0:
+        return jsonify({'message': 'The interval must be divisible by 5 since we have minimum increments of 5 '
+                                   'minutes'}), 404
+
+    step = datetime.timedelta(minutes=interval)
     try:
         session = Session()
-        last_timestamp = session.query(func.max(WeatherData.timestamp)).scalar()
-        session.close()
-
-        if not last_timestamp:
+        version = current_data_version(session)
+        if version is None:
             return jsonify({'message': 'No weather data found.'}), 404
+        response = not_modified(version)
+        if response is not None:
+            return response
+        last_timestamp = hot_store.latest_timestamp() or session.query(func.max(WeatherData.timestamp)).scalar()
 
         end_time = last_timestamp
         start_time = end_time - datetime.timedelta(hours=24)
-        session.close()
+        # Sliced from the in-memory store when it holds the window, otherwise one range query
+        # for the whole window, downsampled to the requested interval in SQL
+        results = hot_store.readings(start_time, end_time, step)
+        if results is None:
+            offset = seconds_between(literal(start_time, DateTime), WeatherData.timestamp)
+            results = session.query(*READING_COLUMNS) \
+                .filter(WeatherData.timestamp.between(start_time, end_time), offset % (interval * 60) == 0) \
+                .order_by(WeatherData.timestamp.asc()) \
+                .all()
+    except Exception as e:
+        return jsonify({'message': 'An error occurred while fetching the last day weather.', 'error': str(e)}), 500
+
+    by_timestamp = {result[TIMESTAMP_POSITION]: result for result in results}
+
+    # Stream the samples as they are serialized, steps without a reading are listed under gaps
+    def generate():
+        gaps = []
+        separator = b''
+        yield b'{"parameters":['
         current_time = start_time
-        parameters_list = []
         while current_time <= end_time:
-            with Session() as session:
-                result = session.query(WeatherData).filter(WeatherData.timestamp == current_time).order_by(
-                    WeatherData.timestamp.asc()).first()
-                if not result:
-                    return jsonify({'message': 'Weather data not found for the requested time interval.'}), 404
-            parameters = {
-                'external_temperature_c': result.external_temperature_c,
-                'wind_speed_unmuted_m_s': result.wind_speed_unmuted_m_s,
-                'wind_speed_m_s': result.wind_speed_m_s,
-                'wind_direction_degrees': result.wind_direction_degrees,
-                'wind_direction_compass': {
-                    'type': 'hortimax.synopta.enum',
-                    'key': 8787,
-                    'value': result.wind_direction_compass[0]},
-                'radiation_intensity_unmuted_w_m2': result.radiation_intensity_unmuted_w_m2,
-                'radiation_intensity_w_m2': result.radiation_intensity_w_m2,
-                'standard_radiation_intensity_w_m2': result.standard_radiation_intensity_w_m2,
-                'radiation_sum_j_cm2': result.radiation_sum_j_cm2,
-                'radiation_from_plant_w_m2': result.radiation_from_plant_w_m2,
-                'precipitation': result.precipitation,
-                'relative_humidity_perc': result.relative_humidity_perc,
-                'moisture_deficit_g_kg': result.moisture_deficit_g_kg,
-                'moisture_deficit_g_m3': result.moisture_deficit_g_m3,
-                'dew_point_temperature_c': result.dew_point_temperature_c,
-                'abs_humidity_g_kg': result.abs_humidity_g_kg,
-                'enthalpy_kj_kg': result.enthalpy_kj_kg,
-                'enthalpy_kj_m3': result.enthalpy_kj_m3,
-                'atmospheric_pressure_hpa': result.atmospheric_pressure_hpa,
-                'status_meteo_station':
-                    {
-                        'type': 'hortimax.synopta.enum',
-                        'key': 8789,
-                        'value': result.status_meteo_station[0]
-                    },
-
-                'status_meteo_station_communication':
-                    {
-                        'type': 'hortimax.synopta.enum',
-                        'key': 8796,
-                        'value': result.status_meteo_station_communication[0]
-                    },
-                'timestamp': str(result.timestamp)
-            }
-            parameters_list.append({f"parameter {current_time}": parameters})
-            interval = request.json.get('interval')
-            print("interval is", interval)
-            if interval is None or interval == '':
-                raise Exception('Interval value is missing')
-            if interval % 5 != 0:
-                return jsonify({'message': 'The interval must be divisible by 5 since we have minimum increments of 5 '
-                                           'minutes'}), 404
-
-            current_time += datetime.timedelta(minutes=interval)
-
-        return jsonify(parameters_list)
+            result = by_timestamp.get(current_time)
+            if result is None:
+                gaps.append(str(current_time))
+            else:
+                yield separator + dumps({f"parameter {current_time}": serialize_reading(result)})
+                separator = b','
+            current_time += step
+        yield b'],"gaps":' + dumps(gaps) + b'}'
+
+    return tagged(Response(generate(), mimetype='application/json'), version)
+
+
+# Export the raw readings of any time range as NDJSON or CSV, streamed one keyset page at a time
+@app.route('/api/export', methods=['GET'])
+def export_weather_data():
+    try:
+        start_time = datetime.datetime.fromisoformat(request.args['start'])
+        end_time = datetime.datetime.fromisoformat(request.args['end'])
+    except (KeyError, ValueError):
+        return jsonify({'message': 'Please add start and end as ISO 8601 timestamps'}), 400
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'message': f'format must be one of {", ".join(EXPORT_FORMATS)}'}), 400
+    fields = ['timestamp']
+    requested = request.args.get('columns')
+    for field in (requested.split(',') if requested else READING_FIELDS):
+        field = field.strip()
+        if field not in READING_FIELDS:
+            return jsonify({'message': f'Unknown column {field}'}), 400
+        if field not in fields:
+            fields.append(field)
+
+    statement = select(*[getattr(WeatherData, field) for field in fields]) \
+        .where(WeatherData.timestamp.between(start_time, end_time)) \
+        .order_by(WeatherData.timestamp.asc()) \
+        .limit(EXPORT_BATCH_SIZE)
+
+    # Read before the rows, so the rows are never older than the version they are tagged with
+    try:
+        version = load_data_version()
     except Exception as e:
-        return jsonify({'message': 'An error occurred while fetching the last day weather.', 'error': str(e)}), 500
+        return jsonify({'message': 'An error occurred while exporting the weather data.', 'error': str(e)}), 500
+    response = not_modified(version) if version is not None else None
+    if response is not None:
+        return response
+
+    # Only one batch of rows is held in memory at a time, whatever the size of the range. Batches are
+    # read by keyset on the unique timestamp, which unlike server-side cursors works with every driver.
+    def generate():
+        session = Session()
+        if export_format == 'csv':
+            yield csv_lines([fields])
+        last_timestamp = None
+        while True:
+            batch = statement if last_timestamp is None else statement.where(WeatherData.timestamp > last_timestamp)
+            rows = session.execute(batch).all()
+            if rows:
+                yield csv_lines(rows) if export_format == 'csv' else ndjson_lines(fields, rows)
+            if len(rows) < EXPORT_BATCH_SIZE:
+                break
+            last_timestamp = rows[-1][0]
+
+    filename = f'weather_data_{start_time:%Y%m%d%H%M}_{end_time:%Y%m%d%H%M}.{export_format}'
+    response = Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format],
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
+    return tagged(response, version) if version is not None else response
+
 
 # Expose the development of the weather parameters over the last 7 days in 1 day increments (average per day)
 @app.route('/api/avg-for-several-days-with-one-day-increment', methods=['GET'])
 def avg_for_several_days_with_one_day_increment():
     try:
-        session = Session()
         increment_interval = request.json.get('increment_interval')
+        increment_unit = request.json.get('increment_unit', 'day')
         total_days = request.json.get('total_days')
-        if increment_interval != 1:
-            return jsonify({'message': 'Please add increment_interval 1'}), 400
-        if total_days > 14:
+        if not isinstance(increment_interval, int) or increment_interval < 1:
+            return jsonify({'message': 'Please add a positive increment_interval'}), 400
+        if increment_unit not in BUCKET_WIDTHS:
+            return jsonify({'message': f'increment_unit must be one of {", ".join(BUCKET_WIDTHS)}'}), 400
+        if not isinstance(total_days, int) or total_days < 1 or total_days > 14:
             return jsonify({'message': 'Please add total_days lesser than 14'}), 400
-        time_stamp = session.query(func.max(WeatherData.timestamp)).scalar()
-        end_time = time_stamp - datetime.timedelta(days=total_days - 1)
-        start_time = end_time - datetime.timedelta(days=increment_interval)
-        print(f"start_time : {start_time}")
-        print(f"end_time : {end_time}")
-        daily_averages_list = {}
-        for i in range(total_days):
-            avg_external_temperature_c = session.query(func.avg(WeatherData.external_temperature_c)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_wind_speed_unmuted_m_s = session.query(func.avg(WeatherData.wind_speed_unmuted_m_s)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_wind_speed_m_s = session.query(func.avg(WeatherData.wind_speed_m_s)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_wind_direction_degrees = session.query(func.avg(WeatherData.wind_direction_degrees)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-            avg_wind_direction_compass = session.query(WeatherData.wind_direction_compass) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time) \
-                .group_by(WeatherData.wind_direction_compass) \
-                .order_by(func.count().desc()) \
-                .first()
-
-            avg_radiation_intensity_unmuted_w_m2 = session.query(func.avg(WeatherData.radiation_intensity_unmuted_w_m2)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_radiation_intensity_w_m2 = session.query(func.avg(WeatherData.radiation_intensity_w_m2)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_standard_radiation_intensity_w_m2 = session.query(
-                func.avg(WeatherData.standard_radiation_intensity_w_m2)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_radiation_sum_j_cm2 = session.query(func.avg(WeatherData.radiation_sum_j_cm2)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_radiation_from_plant_w_m2 = session.query(func.avg(WeatherData.radiation_from_plant_w_m2)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_precipitation = session.query(func.avg(WeatherData.precipitation)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_relative_humidity_perc = session.query(func.avg(WeatherData.relative_humidity_perc)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_moisture_deficit_g_kg = session.query(func.avg(WeatherData.moisture_deficit_g_kg)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_moisture_deficit_g_m3 = session.query(func.avg(WeatherData.moisture_deficit_g_m3)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_dew_point_temperature_c = session.query(func.avg(WeatherData.dew_point_temperature_c)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_abs_humidity_g_kg = session.query(func.avg(WeatherData.abs_humidity_g_kg)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_enthalpy_kj_kg = session.query(func.avg(WeatherData.enthalpy_kj_kg)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_enthalpy_kj_m3 = session.query(func.avg(WeatherData.enthalpy_kj_m3)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_atmospheric_pressure_hpa = session.query(func.avg(WeatherData.atmospheric_pressure_hpa)) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-            avg_status_meteo_station = session.query(WeatherData.status_meteo_station) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time) \
-                .group_by(WeatherData.status_meteo_station) \
-                .order_by(func.count().desc()) \
-                .first()
-
-            avg_status_meteo_station_communication = session.query(WeatherData.status_meteo_station_communication) \
-                .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time) \
-                .group_by(WeatherData.status_meteo_station_communication) \
-                .order_by(func.count().desc()) \
-                .first()
-
-            daily_averages = {
-                'external_temperature_c': avg_external_temperature_c,
-                'wind_speed_unmuted_m_s': avg_wind_speed_unmuted_m_s,
-                'wind_speed_m_s': avg_wind_speed_m_s,
-                'wind_direction_degrees': avg_wind_direction_degrees,
-                'wind_direction_compass': {
-                    'type': 'hortimax.synopta.enum',
-                    'key': 8787,
-                    'value': avg_wind_direction_compass[0]},
-                'radiation_intensity_unmuted_w_m2': avg_radiation_intensity_unmuted_w_m2,
-                'radiation_intensity_w_m2': avg_radiation_intensity_w_m2,
-                'standard_radiation_intensity_w_m2': avg_standard_radiation_intensity_w_m2,
-                'radiation_sum_j_cm2': avg_radiation_sum_j_cm2,
-                'radiation_from_plant_w_m2': avg_radiation_from_plant_w_m2,
-                'precipitation': avg_precipitation,
-                'relative_humidity_perc': avg_relative_humidity_perc,
-                'moisture_deficit_g_kg': avg_moisture_deficit_g_kg,
-                'moisture_deficit_g_m3': avg_moisture_deficit_g_m3,
-                'dew_point_temperature_c': avg_dew_point_temperature_c,
-                'abs_humidity_g_kg': avg_abs_humidity_g_kg,
-                'enthalpy_kj_kg': avg_enthalpy_kj_kg,
-                'enthalpy_kj_m3': avg_enthalpy_kj_m3,
-                'atmospheric_pressure_hpa': avg_atmospheric_pressure_hpa,
-                'status_meteo_station':
-                    {
-                        'type': 'hortimax.synopta.enum',
-                        'key': 8789,
-                        'value': avg_status_meteo_station[0]
-                    },
-
-                'status_meteo_station_communication':
-                    {
-                        'type': 'hortimax.synopta.enum',
-                        'key': 8796,
-                        'value': avg_status_meteo_station_communication[0]
-                    }
-            }
-            daily_averages_list[f"average from {start_time} to {end_time}"] = daily_averages
-
-            end_time = end_time + datetime.timedelta(days=increment_interval)
-            start_time = start_time + datetime.timedelta(days=increment_interval)
-            print(f"start_time : {start_time}")
-            print(f"end_time : {end_time}")
-
-        session.close()
-        return jsonify(daily_averages_list)
+
+        def compute():
+            session = Session()
+            version = current_data_version(session)
+            if version is None:
+                return None
+            end_time = hot_store.latest_timestamp() or session.query(func.max(WeatherData.timestamp)).scalar()
+            start_time = end_time - datetime.timedelta(days=total_days)
+            width = BUCKET_WIDTHS[increment_unit] * increment_interval
+            buckets = hot_store.aggregate_buckets(start_time, end_time, width)
+            if buckets is None:
+                buckets = rollup_aggregate_buckets(session, start_time, end_time, width)
+            daily_averages_list = {}
+            for bucket in buckets:
+                daily_averages_list[f"average from {bucket.start} to {bucket.end}"] = serialize_averages(bucket)
+            return version, dumps(daily_averages_list)
+
+        cache_key = ('avg-for-several-days-with-one-day-increment', total_days, increment_interval, increment_unit)
+        response = cached_response(cache_key, compute)
+        if response is None:
+            return jsonify({'message': 'No weather data found.'}), 404
+        return response
     except Exception as e:
         return jsonify({'message': 'An error occurred while fetching the averages .', 'error': str(e)}), 500
 
@@ -362,131 +350,95 @@ def avg_for_several_days_with_one_day_increment():
 @app.route('/api/avg-for-several-days', methods=['GET'])
 def avg_for_several_days():
     try:
-        session = Session()
         total_days = request.json.get('total_days')
-        if total_days > 14:
-            return jsonify({'Please add total days lesser or equal to 14'}), 400
-
-        end_time = session.query(func.max(WeatherData.timestamp)).scalar()
-        start_time = end_time - datetime.timedelta(days=total_days)
-
-        avg_external_temperature_c = session.query(func.avg(WeatherData.external_temperature_c)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_wind_speed_unmuted_m_s = session.query(func.avg(WeatherData.wind_speed_unmuted_m_s)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_wind_speed_m_s = session.query(func.avg(WeatherData.wind_speed_m_s)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_wind_direction_degrees = session.query(func.avg(WeatherData.wind_direction_degrees)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_wind_direction_compass = session.query(WeatherData.wind_direction_compass) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time) \
-            .group_by(WeatherData.wind_direction_compass) \
-            .order_by(func.count().desc()) \
-            .first()
-
-        avg_radiation_intensity_unmuted_w_m2 = session.query(func.avg(WeatherData.radiation_intensity_unmuted_w_m2)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_radiation_intensity_w_m2 = session.query(func.avg(WeatherData.radiation_intensity_w_m2)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_standard_radiation_intensity_w_m2 = session.query(func.avg(WeatherData.standard_radiation_intensity_w_m2)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_radiation_sum_j_cm2 = session.query(func.avg(WeatherData.radiation_sum_j_cm2)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_radiation_from_plant_w_m2 = session.query(func.avg(WeatherData.radiation_from_plant_w_m2)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_precipitation = session.query(func.avg(WeatherData.precipitation)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_relative_humidity_perc = session.query(func.avg(WeatherData.relative_humidity_perc)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_moisture_deficit_g_kg = session.query(func.avg(WeatherData.moisture_deficit_g_kg)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_moisture_deficit_g_m3 = session.query(func.avg(WeatherData.moisture_deficit_g_m3)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_dew_point_temperature_c = session.query(func.avg(WeatherData.dew_point_temperature_c)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_abs_humidity_g_kg = session.query(func.avg(WeatherData.abs_humidity_g_kg)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_enthalpy_kj_kg = session.query(func.avg(WeatherData.enthalpy_kj_kg)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_enthalpy_kj_m3 = session.query(func.avg(WeatherData.enthalpy_kj_m3)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_atmospheric_pressure_hpa = session.query(func.avg(WeatherData.atmospheric_pressure_hpa)) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time).scalar()
-
-        avg_status_meteo_station = session.query(WeatherData.status_meteo_station) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time) \
-            .group_by(WeatherData.status_meteo_station) \
-            .order_by(func.count().desc()) \
-            .first()
-
-        avg_status_meteo_station_communication = session.query(WeatherData.status_meteo_station_communication) \
-            .filter(WeatherData.timestamp >= start_time, WeatherData.timestamp <= end_time) \
-            .group_by(WeatherData.status_meteo_station_communication) \
-            .order_by(func.count().desc()) \
-            .first()
-
-        session.close()
-        total_average = []
-        averages = {
-            'external_temperature_c': avg_external_temperature_c,
-            'wind_speed_unmuted_m_s': avg_wind_speed_unmuted_m_s,
-            'wind_speed_m_s': avg_wind_speed_m_s,
-            'wind_direction_degrees': avg_wind_direction_degrees,
-            'wind_direction_compass': {
-                'type': 'hortimax.synopta.enum',
-                'key': 8787,
-                'value': avg_wind_direction_compass[0]},
-            'radiation_intensity_unmuted_w_m2': avg_radiation_intensity_unmuted_w_m2,
-            'radiation_intensity_w_m2': avg_radiation_intensity_w_m2,
-            'standard_radiation_intensity_w_m2': avg_standard_radiation_intensity_w_m2,
-            'radiation_sum_j_cm2': avg_radiation_sum_j_cm2,
-            'radiation_from_plant_w_m2': avg_radiation_from_plant_w_m2,
-            'precipitation': avg_precipitation,
-            'relative_humidity_perc': avg_relative_humidity_perc,
-            'moisture_deficit_g_kg': avg_moisture_deficit_g_kg,
-            'moisture_deficit_g_m3': avg_moisture_deficit_g_m3,
-            'dew_point_temperature_c': avg_dew_point_temperature_c,
-            'abs_humidity_g_kg': avg_abs_humidity_g_kg,
-            'enthalpy_kj_kg': avg_enthalpy_kj_kg,
-            'enthalpy_kj_m3': avg_enthalpy_kj_m3,
-            'atmospheric_pressure_hpa': avg_atmospheric_pressure_hpa,
-            'status_meteo_station':
-                {
-                    'type': 'hortimax.synopta.enum',
-                    'key': 8789,
-                    'value': avg_status_meteo_station[0]
-                },
-
-            'status_meteo_station_communication': {
-                'type': 'hortimax.synopta.enum',
-                'key': 8796,
-                'value': avg_status_meteo_station_communication[0]
-            }
-        }
-        total_average.append({f"average from {start_time} to {end_time}": averages})
-        return jsonify(total_average)
+        if not isinstance(total_days, int) or total_days < 1 or total_days > 14:
+            return jsonify({'message': 'Please add total days lesser or equal to 14'}), 400
+
+        def compute():
+            session = Session()
+            version = current_data_version(session)
+            if version is None:
+                return None
+            end_time = hot_store.latest_timestamp() or session.query(func.max(WeatherData.timestamp)).scalar()
+            start_time = end_time - datetime.timedelta(days=total_days)
+            bucket, = hot_store.aggregate_buckets(start_time, end_time, end_time - start_time) or \
+                rollup_aggregate_buckets(session, start_time, end_time, end_time - start_time)
+            return version, dumps([{f"average from {start_time} to {end_time}": serialize_averages(bucket)}])
+
+        response = cached_response(('avg-for-several-days', total_days), compute)
+        if response is None:
+            return jsonify({'message': 'No weather data found.'}), 404
+        return response
     except Exception as e:
         return jsonify(
             {'message': 'An error occurred while fetching the average of several days .', 'error': str(e)}), 500
 
 
+# Per bucket statistics of a window computed on NumPy arrays: circular mean and resultant length of the
+# wind direction, min/max/mean/std/percentiles of every float column and the vapour pressure deficit.
+# The window is ?start=...&end=... (ISO 8601), or the last ?days=... (default 7) up to the latest reading.
+@app.route('/api/analytics', methods=['GET'])
+def weather_analytics():
+    unit = request.args.get('unit', 'day')
+    if unit not in BUCKET_WIDTHS:
+        return jsonify({'message': f'unit must be one of {", ".join(BUCKET_WIDTHS)}'}), 400
+    interval = request.args.get('interval', 1, type=int)
+    days = request.args.get('days', 7, type=int)
+    if interval < 1 or days < 1:
+        return jsonify({'message': 'interval and days must be positive integers'}), 400
+    if days > ANALYTICS_MAX_DAYS:
+        return jsonify({'message': f'days must be at most {ANALYTICS_MAX_DAYS}'}), 400
+    try:
+        width = BUCKET_WIDTHS[unit] * interval
+    except OverflowError:
+        return jsonify({'message': 'interval is too large'}), 400
+    try:
+        percentiles = tuple(float(value) for value in request.args['percentiles'].split(',')) \
+            if 'percentiles' in request.args else DEFAULT_PERCENTILES
+        start_time = datetime.datetime.fromisoformat(request.args['start']) if 'start' in request.args else None
+        end_time = datetime.datetime.fromisoformat(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        return jsonify({'message': 'percentiles must be numbers, start and end ISO 8601 timestamps'}), 400
+    if not all(0 <= percentile <= 100 for percentile in percentiles):
+        return jsonify({'message': 'percentiles must be between 0 and 100'}), 400
+    if start_time and end_time and start_time >= end_time:
+        return jsonify({'message': 'start must be before end'}), 400
+
+    try:
+        def compute():
+            session = Session()
+            version = load_data_version(session)
+            if version is None:
+                return None
+            end = end_time or session.query(func.max(WeatherData.timestamp)).scalar()
+            start = start_time or end - datetime.timedelta(days=days)
+            if start >= end:
+                return None
+            return version, dumps(window_analytics(session, start, end, width, percentiles))
+
+        response = cached_response(('analytics', request.query_string), compute)
+        if response is None:
+            return jsonify({'message': 'No weather data found.'}), 404
+        return response
+    except Exception as e:
+        return jsonify({'message': 'An error occurred while computing the analytics.', 'error': str(e)}), 500
+
+
+# Hit and miss counters of the read endpoint cache, to size CACHE_MAX_ENTRIES and CACHE_TTL_SECONDS
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(response_cache.stats())
+
+
+# Request, database and ingest counters in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    stats = response_cache.stats()
+    cache_counters = [('weather_cache_hits_total', 'Read endpoint cache hits.', stats['hits']),
+                      ('weather_cache_misses_total', 'Read endpoint cache misses.', stats['misses'])]
+    return Response(metrics.render(cache_counters), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     # serve(app, host='0.0.0.0', port=8000, threads=1)
     app.run(host='0.0.0.0', port=8000, debug=True)
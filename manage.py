@@ -0,0 +1,125 @@
+import argparse
+import datetime
+import os
+
+from sqlalchemy import delete, func, inspect, select, text
+from database import Base, Session, engine
+from models import ROLLUP_MODELS, WeatherData
+from rollups import backfill_rollups
+from retention import compact_readings
+
+TIMESTAMP_INDEX = 'ix_weather_data_timestamp'
+
+# Empty monthly partitions kept ahead of the current month, run partition-monthly again before they run out
+PARTITION_MONTHS_AHEAD = 3
+
+# Raw readings older than this are downsampled by the compact command
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 365))
+
+
+# Add the unique timestamp index to a weather_data table created before it was declared
+def add_timestamp_index():
+    existing = {index['name'] for index in inspect(engine).get_indexes(WeatherData.__tablename__)}
+    if TIMESTAMP_INDEX in existing:
+        print(f'{TIMESTAMP_INDEX} already exists.')
+        return
+    index = next(index for index in WeatherData.__table__.indexes if index.name == TIMESTAMP_INDEX)
+    with engine.begin() as connection:
+        # A unique index cannot be built over duplicated readings, keep the first row of each timestamp
+        keep = select(func.min(WeatherData.id).label('id')).group_by(WeatherData.timestamp).subquery()
+        removed = connection.execute(delete(WeatherData).where(WeatherData.id.not_in(select(keep.c.id))))
+        print(f'Removed {removed.rowcount} duplicated readings.')
+        index.create(connection)
+    print(f'Created {TIMESTAMP_INDEX}.')
+
+
+# Rebuild the rollup tables from weather_data
+def backfill():
+    session = Session()
+    try:
+        chunks = backfill_rollups(session)
+    finally:
+        session.close()
+    print(f'Rebuilt rollups in {chunks} chunks.')
+
+
+# Create the missing tables from the models and bring existing ones up to date
+def init_db():
+    existing_tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+    add_timestamp_index()
+    if any(model.__tablename__ not in existing_tables for model in ROLLUP_MODELS):
+        backfill()
+
+
+def _next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _partition(month):
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN (TO_DAYS('{_next_month(month):%Y-%m-%d}'))"
+
+
+# Partition weather_data by month on timestamp (MySQL only) so that recent windows only scan
+# recent partitions, or add the partitions of the coming months to an already partitioned table
+def partition_monthly():
+    table = WeatherData.__tablename__
+    if engine.dialect.name not in ('mysql', 'mariadb'):
+        print(f'Partitioning is only supported on MySQL, {engine.dialect.name} keeps {table} as a single table.')
+        return
+    with engine.begin() as connection:
+        existing = connection.execute(text(
+            'SELECT partition_name FROM information_schema.partitions '
+            'WHERE table_schema = DATABASE() AND table_name = :table AND partition_name IS NOT NULL'),
+            {'table': table}).scalars().all()
+        first = connection.execute(select(func.min(WeatherData.timestamp))).scalar() or datetime.datetime.now()
+        month = first.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        partitioned_months = [datetime.datetime.strptime(name, 'p%Y%m') for name in existing if name != 'pmax']
+        if partitioned_months:
+            month = _next_month(max(partitioned_months))
+        last = datetime.datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for _ in range(PARTITION_MONTHS_AHEAD):
+            last = _next_month(last)
+        partitions = []
+        while month <= last:
+            partitions.append(_partition(month))
+            month = _next_month(month)
+        partitions.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+
+        if not existing:
+            # Every unique key of a partitioned table must hold the partitioning column
+            connection.execute(text(f'ALTER TABLE {table} MODIFY timestamp DATETIME NOT NULL'))
+            connection.execute(text(f'ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)'))
+            connection.execute(text(f'ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS(timestamp)) '
+                                    f'({", ".join(partitions)})'))
+        elif len(partitions) > 1:
+            connection.execute(text(f'ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ({", ".join(partitions)})'))
+    print(f'Added {len(partitions) - 1} monthly partitions to {table}.')
+
+
+# Downsample the raw readings older than retention_days into hourly rows
+def compact(retention_days):
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    session = Session()
+    try:
+        days = compact_readings(session, cutoff)
+    finally:
+        session.close()
+    print(f'Compacted {days} days of readings older than {cutoff:%Y-%m-%d}.')
+
+
+COMMANDS = {
+    'init-db': lambda args: init_db(),
+    'backfill-rollups': lambda args: backfill(),
+    'partition-monthly': lambda args: partition_monthly(),
+    'compact': lambda args: compact(args.retention_days),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Database maintenance commands.')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--retention-days', type=int, default=RETENTION_DAYS,
+                        help='compact: raw readings older than this many days are downsampled to hourly rows')
+    args = parser.parse_args()
+    COMMANDS[args.command](args)
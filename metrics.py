@@ -0,0 +1,187 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Requests slower than this are logged with the statements they ran, 0 turns the log off
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', 0)) / 1000
+
+# Statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 50
+
+slow_request_log = logging.getLogger('weather.slow_requests')
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+# Process-wide counters, rendered in the Prometheus text exposition format
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(Histogram)
+        self.statements = defaultdict(int)
+        self.db_seconds = defaultdict(float)
+        self.serialization_seconds = defaultdict(float)
+        self.ingest_rows = 0
+        self.ingest_seconds = 0.0
+        self.ingest_rows_per_second = 0.0
+
+    def record_request(self, endpoint, method, status, seconds, statements, db_seconds, serialization_seconds):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.latency[endpoint].observe(seconds)
+            self.statements[endpoint] += statements
+            self.db_seconds[endpoint] += db_seconds
+            self.serialization_seconds[endpoint] += serialization_seconds
+
+    def record_ingest(self, rows, seconds):
+        with self._lock:
+            self.ingest_rows += rows
+            self.ingest_seconds += seconds
+            if seconds > 0:
+                self.ingest_rows_per_second = rows / seconds
+
+    def render(self, extra_counters=()):
+        with self._lock:
+            lines = ['# HELP weather_http_requests_total Requests handled, by endpoint, method and status.',
+                     '# TYPE weather_http_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'weather_http_requests_total{_labels(endpoint=endpoint, method=method, status=status)}'
+                             f' {count}')
+
+            lines += ['# HELP weather_http_request_duration_seconds Time until the response body was sent.',
+                      '# TYPE weather_http_request_duration_seconds histogram']
+            for endpoint, histogram in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'weather_http_request_duration_seconds_bucket{_labels(endpoint=endpoint, le=bound)}'
+                                 f' {cumulative}')
+                lines.append(f'weather_http_request_duration_seconds_bucket{_labels(endpoint=endpoint, le="+Inf")}'
+                             f' {histogram.count}')
+                lines.append(f'weather_http_request_duration_seconds_sum{_labels(endpoint=endpoint)} {histogram.sum}')
+                lines.append(f'weather_http_request_duration_seconds_count{_labels(endpoint=endpoint)}'
+                             f' {histogram.count}')
+
+            for name, description, values in (
+                    ('weather_db_statements_total', 'SQL statements executed while handling requests.',
+                     self.statements),
+                    ('weather_db_seconds_total', 'Time spent executing SQL statements while handling requests.',
+                     self.db_seconds),
+                    ('weather_serialization_seconds_total', 'Time spent encoding response bodies.',
+                     self.serialization_seconds)):
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+                lines += [f'{name}{_labels(endpoint=endpoint)} {value}' for endpoint, value in sorted(values.items())]
+
+            lines += ['# HELP weather_ingest_rows_total Readings written by the ingest path.',
+                      '# TYPE weather_ingest_rows_total counter',
+                      f'weather_ingest_rows_total {self.ingest_rows}',
+                      '# HELP weather_ingest_write_seconds_total Time spent writing ingest batches.',
+                      '# TYPE weather_ingest_write_seconds_total counter',
+                      f'weather_ingest_write_seconds_total {self.ingest_seconds}',
+                      '# HELP weather_ingest_rows_per_second Write throughput of the last ingest batch.',
+                      '# TYPE weather_ingest_rows_per_second gauge',
+                      f'weather_ingest_rows_per_second {self.ingest_rows_per_second}']
+
+        for name, description, value in extra_counters:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# Add the time spent encoding a response body to the current request
+def record_serialization(seconds):
+    if has_request_context() and 'metrics_started' in g:
+        g.serialization_seconds += seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    if has_request_context() and 'metrics_started' in g:
+        g.statements += 1
+        g.db_seconds += elapsed
+        if SLOW_REQUEST_SECONDS and len(g.statement_log) < MAX_LOGGED_STATEMENTS:
+            g.statement_log.append((elapsed, statement))
+
+
+# A failed statement never reaches after_cursor_execute, drop its start time so the connection's
+# stack stays matched once it is back in the pool
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_started'):
+        conn.info['query_started'].pop()
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.statements = 0
+    g.db_seconds = 0.0
+    g.serialization_seconds = 0.0
+    g.statement_log = []
+
+
+# Streamed bodies are still being produced when after_request runs, so the request is recorded once
+# the server closes the response. The request context may be gone by then, what is needed is kept here.
+def _after_request(response):
+    stats = g._get_current_object()
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    method, full_path, status = request.method, request.full_path, response.status_code
+
+    def record():
+        elapsed = time.perf_counter() - stats.metrics_started
+        metrics.record_request(endpoint, method, status, elapsed, stats.statements, stats.db_seconds,
+                               stats.serialization_seconds)
+        if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+            statements = '\n'.join(f'  {seconds * 1000:.1f} ms: {" ".join(statement.split())}'
+                                   for seconds, statement in stats.statement_log)
+            slow_request_log.warning('Slow request %s %s took %.1f ms, %d statements in %.1f ms:\n%s',
+                                     method, full_path, elapsed * 1000, stats.statements,
+                                     stats.db_seconds * 1000, statements)
+
+    response.call_on_close(record)
+    return response
+
+
+# Time every request of app and every statement run on engine
+def init_metrics(app, engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -1,9 +1,13 @@
 
-from sqlalchemy import  Column, Integer, Float, Enum, DateTime
+import datetime
+
+from sqlalchemy import  Column, Integer, Float, Double, Enum, DateTime, Index, String
 from database import Base
 
 class WeatherData(Base):
     __tablename__ = 'weather_data'
+    # One reading per timestamp: latest and range queries become index seeks and re-ingest upserts
+    __table_args__ = (Index('ix_weather_data_timestamp', 'timestamp', unique=True),)
     id = Column(Integer, primary_key=True)
     external_temperature_c = Column(Float)
     wind_speed_unmuted_m_s = Column(Float)
@@ -27,4 +31,67 @@ class WeatherData(Base):
     atmospheric_pressure_hpa = Column(Float)
     status_meteo_station = Column(Enum('Actief', 'Inactief'))
     status_meteo_station_communication = Column(Enum('Online', 'Offline'))
-    timestamp = Column(DateTime)
\ No newline at end of file
+    timestamp = Column(DateTime)
+
+
+# One row per climate computer dump already ingested, so re-uploaded archives only cost their new readings
+class IngestManifest(Base):
+    __tablename__ = 'ingest_manifest'
+    id = Column(Integer, primary_key=True)
+    source_name = Column(String(255), nullable=False)
+    # SHA-256 of the raw file, identical dumps are skipped before they are parsed
+    content_hash = Column(String(64), nullable=False, unique=True)
+    reading_timestamp = Column(DateTime)
+    ingested_at = Column(DateTime, nullable=False)
+
+
+# One row per day handled by the compact command, the latest one is where the next run resumes
+class CompactedDay(Base):
+    __tablename__ = 'compacted_days'
+    day = Column(DateTime, primary_key=True)
+    compacted_at = Column(DateTime, nullable=False)
+
+
+# Numeric columns, aggregated as sum, min and max
+NUMERIC_COLUMNS = [
+    'external_temperature_c', 'wind_speed_unmuted_m_s', 'wind_speed_m_s', 'wind_direction_degrees',
+    'radiation_intensity_unmuted_w_m2', 'radiation_intensity_w_m2', 'standard_radiation_intensity_w_m2',
+    'radiation_sum_j_cm2', 'radiation_from_plant_w_m2', 'precipitation', 'relative_humidity_perc',
+    'moisture_deficit_g_kg', 'moisture_deficit_g_m3', 'dew_point_temperature_c', 'abs_humidity_g_kg',
+    'enthalpy_kj_kg', 'enthalpy_kj_m3', 'atmospheric_pressure_hpa',
+]
+
+# Enum columns, aggregated as a histogram of their values
+ENUM_COLUMNS = ['wind_direction_compass', 'status_meteo_station', 'status_meteo_station_communication']
+ENUM_VALUES = {column: list(getattr(WeatherData, column).type.enums) for column in ENUM_COLUMNS}
+
+
+def histogram_column(column, value):
+    return f'{column}_{value}'
+
+
+# Pre-aggregated weather_data over fixed buckets: per bucket the number of readings, sum, min
+# and max of every numeric column and a count per enum value. Kept up to date by the ingest path.
+def _rollup_model(class_name, table_name, bucket_width):
+    attributes = {
+        '__tablename__': table_name,
+        'bucket_width': bucket_width,
+        'bucket_start': Column(DateTime, primary_key=True),
+        'sample_count': Column(Integer, nullable=False),
+    }
+    for column in NUMERIC_COLUMNS:
+        attributes[f'{column}_sum'] = Column(Double)
+        attributes[f'{column}_min'] = Column(Float)
+        attributes[f'{column}_max'] = Column(Float)
+    for column in ENUM_COLUMNS:
+        for value in ENUM_VALUES[column]:
+            attributes[histogram_column(column, value)] = Column(Integer, nullable=False, default=0)
+    return type(class_name, (Base,), attributes)
+
+
+WeatherRollup15Min = _rollup_model('WeatherRollup15Min', 'weather_rollup_15min', datetime.timedelta(minutes=15))
+WeatherRollupHourly = _rollup_model('WeatherRollupHourly', 'weather_rollup_hourly', datetime.timedelta(hours=1))
+WeatherRollupDaily = _rollup_model('WeatherRollupDaily', 'weather_rollup_daily', datetime.timedelta(days=1))
+
+# Coarsest first, the order in which rollups are used to cover a time range
+ROLLUP_MODELS = [WeatherRollupDaily, WeatherRollupHourly, WeatherRollup15Min]
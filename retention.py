@@ -0,0 +1,87 @@
+import datetime
+
+import numpy as np
+from sqlalchemy import DateTime, delete, func, insert, literal, select
+from aggregation import aggregate_buckets, seconds_between
+from analytics import circular_statistics
+from models import CompactedDay, WeatherData
+from rollups import DAY, GRID_ORIGIN, RESOLUTION, floor_to_grid, lock_rollup_days, refresh_rollups, \
+    release_rollup_days
+
+# Width of the rows that old raw readings are downsampled to
+COMPACTED_WIDTH = datetime.timedelta(hours=1)
+
+
+# Circular mean of the wind direction per compacted bucket of [start, end), averaging degrees would
+# turn 350 and 10 into 180
+def _wind_directions(session, start, end, bucket_count):
+    offset = seconds_between(literal(start, DateTime), WeatherData.timestamp)
+    result = session.execute(select(offset, WeatherData.wind_direction_degrees)
+                             .where(WeatherData.timestamp >= start, WeatherData.timestamp < end))
+    values = np.array([tuple(row) for row in result], dtype=np.float64).reshape(-1, 2)
+    buckets = (values[:, 0] // COMPACTED_WIDTH.total_seconds()).astype(np.int64)
+    directions, _ = circular_statistics(values[:, 1], buckets, bucket_count)
+    return directions
+
+
+# Replace the raw readings of one day by one row per COMPACTED_WIDTH holding their averages and
+# most frequent enum values, then refresh the rollups of that day. Returns False when the day
+# has nothing left to compact.
+def compact_day(session, day):
+    end = day + DAY
+    buckets = aggregate_buckets(session, day, end, COMPACTED_WIDTH, include_end=False)
+    if all(bucket.count <= 1 for bucket in buckets):
+        return False
+    directions = _wind_directions(session, day, end, len(buckets))
+    rows = []
+    for bucket, direction in zip(buckets, directions.tolist()):
+        if not bucket.count:
+            continue
+        row = bucket.averages()
+        row.update(bucket.modes())
+        row['wind_direction_degrees'] = None if np.isnan(direction) else round(direction) % 360
+        row['timestamp'] = bucket.start
+        rows.append(row)
+    session.execute(delete(WeatherData).where(WeatherData.timestamp >= day, WeatherData.timestamp < end))
+    session.execute(insert(WeatherData), rows)
+    refresh_rollups(session, day, end - RESOLUTION)
+    return True
+
+
+# Earliest reading of [start, cutoff) that is off the COMPACTED_WIDTH grid, which compacted rows
+# are always on. None when there is nothing left to compact.
+def first_uncompacted(session, start, cutoff):
+    offset = seconds_between(literal(GRID_ORIGIN, DateTime), WeatherData.timestamp)
+    criteria = [WeatherData.timestamp < cutoff, offset % int(COMPACTED_WIDTH.total_seconds()) != 0]
+    if start is not None:
+        criteria.append(WeatherData.timestamp >= start)
+    return session.execute(select(WeatherData.timestamp)
+                           .where(*criteria)
+                           .order_by(WeatherData.timestamp.asc())
+                           .limit(1)).scalar()
+
+
+# Downsample every day of raw readings before cutoff, one transaction per day so the tables stay
+# usable while it runs. Every day handled is recorded in compacted_days, and the next run only
+# looks at readings after the latest one, so its cost does not grow with the compacted history.
+# Readings ingested later into a recorded day are left as they are. Returns the number of days compacted.
+def compact_readings(session, cutoff):
+    watermark = session.execute(select(func.max(CompactedDay.day))).scalar()
+    first = first_uncompacted(session, watermark + DAY if watermark is not None else None, cutoff)
+    # End the read transaction, every day below takes its rollup lock before its first read
+    session.commit()
+    if first is None:
+        return 0
+    compacted = 0
+    day = floor_to_grid(first, DAY)
+    while day + DAY <= cutoff:
+        try:
+            lock_rollup_days(session, [day])
+            if compact_day(session, day):
+                compacted += 1
+            session.execute(insert(CompactedDay), [{'day': day, 'compacted_at': datetime.datetime.now()}])
+            session.commit()
+        finally:
+            release_rollup_days(session)
+        day += DAY
+    return compacted
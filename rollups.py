@@ -0,0 +1,189 @@
+import bisect
+import datetime
+import os
+
+from sqlalchemy import and_, delete, func, insert, or_, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from aggregation import BucketAggregate, aggregate_buckets, bucket_bounds, bucket_rows, unpack_aggregates
+from models import ENUM_COLUMNS, ENUM_VALUES, NUMERIC_COLUMNS, ROLLUP_MODELS, WeatherData, histogram_column
+
+# Rollup buckets are aligned on this instant, so daily buckets start at midnight
+GRID_ORIGIN = datetime.datetime(2000, 1, 1)
+DAY = datetime.timedelta(days=1)
+
+# Smallest step between two stored timestamps, used to turn a closed range end into an open one
+RESOLUTION = datetime.timedelta(microseconds=1)
+
+# Days recomputed per transaction by backfill_rollups
+BACKFILL_CHUNK_DAYS = 31
+
+# Seconds a writer waits for another one that is refreshing the rollups of the same days
+ROLLUP_LOCK_TIMEOUT = int(os.environ.get('ROLLUP_LOCK_TIMEOUT', 60))
+
+
+def floor_to_grid(timestamp, width):
+    return GRID_ORIGIN + (timestamp - GRID_ORIGIN) // width * width
+
+
+def ceil_to_grid(timestamp, width):
+    floored = floor_to_grid(timestamp, width)
+    return floored if floored == timestamp else floored + width
+
+
+def _rollup_row(bucket):
+    row = {'bucket_start': bucket.start, 'sample_count': bucket.count}
+    for column in NUMERIC_COLUMNS:
+        row[f'{column}_sum'] = bucket.sums[column]
+        row[f'{column}_min'] = bucket.mins[column]
+        row[f'{column}_max'] = bucket.maxs[column]
+    for column in ENUM_COLUMNS:
+        for value, count in bucket.histograms[column].items():
+            row[histogram_column(column, value)] = count
+    return row
+
+
+# Columns of a rollup table in the layout of aggregation.unpack_aggregates
+def _aggregate_columns(table):
+    columns = [table.c.sample_count]
+    for column in NUMERIC_COLUMNS:
+        columns += [table.c[f'{column}_sum'], table.c[f'{column}_min'], table.c[f'{column}_max']]
+    for column in ENUM_COLUMNS:
+        columns += [table.c[histogram_column(column, value)] for value in ENUM_VALUES[column]]
+    return columns
+
+
+# Recompute every rollup bucket of the days overlapping [start, end] from weather_data. The
+# finest buckets come from one grouped SELECT and are folded into the coarser ones in Python.
+# Existing buckets of those days are replaced, so refreshing the same range twice is harmless.
+def refresh_rollups(session, start, end):
+    first = floor_to_grid(start, DAY)
+    last = floor_to_grid(end, DAY) + DAY
+    finest = ROLLUP_MODELS[-1].bucket_width
+    fine_buckets = aggregate_buckets(session, first, last, finest, include_end=False)
+    for model in ROLLUP_MODELS:
+        width = model.bucket_width
+        per_bucket = width // finest
+        rows = []
+        for i in range(0, len(fine_buckets), per_bucket):
+            bucket = BucketAggregate(fine_buckets[i].start, fine_buckets[i].start + width)
+            for fine_bucket in fine_buckets[i:i + per_bucket]:
+                bucket.merge_bucket(fine_bucket)
+            if bucket.count:
+                rows.append(_rollup_row(bucket))
+        session.execute(delete(model).where(model.bucket_start >= first, model.bucket_start < last))
+        if rows:
+            session.execute(insert(model), rows)
+
+
+# Serialize the writers of the days holding the given timestamps. The rollups of a day are
+# recomputed from weather_data and replaced, so a writer whose read missed the uncommitted rows of
+# another would drop them from the rollups. Call it before the transaction's first read, so that
+# read sees everything the previous holder committed. MySQL named locks outlive the transaction
+# and are given back by release_rollup_days, PostgreSQL advisory locks end with the transaction
+# and SQLite lets one writer in at a time anyway.
+def lock_rollup_days(session, timestamps):
+    dialect = session.get_bind().dialect.name
+    # Always taken in day order, so two writers never wait on each other
+    for day in sorted({floor_to_grid(timestamp, DAY) for timestamp in timestamps}):
+        name = f'weather_rollups_{day:%Y%m%d}'
+        if dialect in ('mysql', 'mariadb'):
+            acquired = session.execute(text('SELECT GET_LOCK(:name, :timeout)'),
+                                       {'name': name, 'timeout': ROLLUP_LOCK_TIMEOUT}).scalar()
+            if acquired != 1:
+                raise TimeoutError(f'Timed out waiting for the rollup lock of {day:%Y-%m-%d}')
+        elif dialect == 'postgresql':
+            session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:name))'), {'name': name})
+
+
+# Give back the MySQL named locks of lock_rollup_days, once the transaction is committed or rolled back
+def release_rollup_days(session):
+    if session.get_bind().dialect.name not in ('mysql', 'mariadb'):
+        return
+    try:
+        session.execute(text('SELECT RELEASE_ALL_LOCKS()'))
+        session.commit()
+    except SQLAlchemyError as e:
+        # Named locks are released with the connection as well
+        print(f"Error occurred while releasing the rollup locks: {str(e)}")
+
+
+# Refresh the rollups of the days holding the given reading timestamps, consecutive days in one go
+def refresh_rollups_for(session, timestamps):
+    days = sorted({floor_to_grid(timestamp, DAY) for timestamp in timestamps})
+    if not days:
+        return
+    run_start = previous = days[0]
+    for day in days[1:]:
+        if day - previous > DAY:
+            refresh_rollups(session, run_start, previous)
+            run_start = day
+        previous = day
+    refresh_rollups(session, run_start, previous)
+
+
+# Rebuild the rollups of all stored readings, one transaction per BACKFILL_CHUNK_DAYS days
+def backfill_rollups(session):
+    first, last = session.query(func.min(WeatherData.timestamp), func.max(WeatherData.timestamp)).one()
+    # End the read transaction, every chunk below takes its locks before its first read
+    session.commit()
+    if first is None:
+        return 0
+    chunk_start = floor_to_grid(first, DAY)
+    chunks = 0
+    while chunk_start <= last:
+        chunk_end = chunk_start + (BACKFILL_CHUNK_DAYS - 1) * DAY
+        try:
+            lock_rollup_days(session, [chunk_start + i * DAY for i in range(BACKFILL_CHUNK_DAYS)])
+            refresh_rollups(session, chunk_start, chunk_end)
+            session.commit()
+        finally:
+            release_rollup_days(session)
+        chunks += 1
+        chunk_start = chunk_end + DAY
+    return chunks
+
+
+# Split [lo, hi) into the coarsest aligned rollup ranges that fit inside it. Pieces that are
+# not aligned on any rollup grid come back with model None and are read from weather_data.
+def _cover(lo, hi, models):
+    if lo >= hi:
+        return []
+    if not models:
+        return [(None, lo, hi)]
+    model, finer = models[0], models[1:]
+    first, last = ceil_to_grid(lo, model.bucket_width), floor_to_grid(hi, model.bucket_width)
+    if first >= last:
+        return _cover(lo, hi, finer)
+    return _cover(lo, first, finer) + [(model, first, last)] + _cover(last, hi, finer)
+
+
+# Same result as aggregation.aggregate_buckets, read from the rollup tables. Each bucket is
+# covered by the coarsest rollup buckets that fit inside it, only its unaligned edges are
+# aggregated from weather_data. Costs one query per rollup table plus one for the edges.
+def rollup_aggregate_buckets(session, start, end, width):
+    buckets = [BucketAggregate(lo, hi) for lo, hi in bucket_bounds(start, end, width)]
+    bucket_count = len(buckets)
+    # The readings at end belong to the last bucket
+    bounds = [bucket.start for bucket in buckets] + [end + RESOLUTION]
+
+    pieces = {model: [] for model in ROLLUP_MODELS}
+    edges = []
+    for i in range(bucket_count):
+        for model, lo, hi in _cover(bounds[i], bounds[i + 1], ROLLUP_MODELS):
+            (pieces[model] if model is not None else edges).append((lo, hi))
+
+    for model, ranges in pieces.items():
+        if not ranges:
+            continue
+        table = model.__table__
+        rows = session.execute(
+            select(table.c.bucket_start, *_aggregate_columns(table))
+            .where(or_(*[and_(table.c.bucket_start >= lo, table.c.bucket_start < hi) for lo, hi in ranges])))
+        for row in rows:
+            buckets[bisect.bisect_right(bounds, row[0]) - 1].merge(*unpack_aggregates(row[1:]))
+
+    if edges:
+        criteria = or_(*[and_(WeatherData.timestamp >= lo, WeatherData.timestamp < hi) for lo, hi in edges])
+        for index, *aggregates in bucket_rows(session, start, width, criteria):
+            buckets[min(index, bucket_count - 1)].merge(*aggregates)
+    return buckets
@@ -0,0 +1,86 @@
+import csv
+import io
+import json
+import time
+
+from models import ENUM_COLUMNS, WeatherData
+from metrics import record_serialization
+
+# orjson is optional, it is several times faster than json when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENUM_TYPE = 'hortimax.synopta.enum'
+
+# Keys of the hortimax.synopta.enum wrappers the climate computer uses for the enum columns
+ENUM_KEYS = {'wind_direction_compass': 8787, 'status_meteo_station': 8789, 'status_meteo_station_communication': 8796}
+
+# Fields of a serialized reading, in output order
+READING_FIELDS = [
+    'timestamp', 'external_temperature_c', 'wind_speed_unmuted_m_s', 'wind_speed_m_s', 'wind_direction_degrees',
+    'wind_direction_compass', 'radiation_intensity_unmuted_w_m2', 'radiation_intensity_w_m2',
+    'standard_radiation_intensity_w_m2', 'radiation_sum_j_cm2', 'radiation_from_plant_w_m2', 'precipitation',
+    'relative_humidity_perc', 'moisture_deficit_g_kg', 'moisture_deficit_g_m3', 'dew_point_temperature_c',
+    'abs_humidity_g_kg', 'enthalpy_kj_kg', 'enthalpy_kj_m3', 'atmospheric_pressure_hpa', 'status_meteo_station',
+    'status_meteo_station_communication',
+]
+
+# Select these instead of WeatherData to get plain tuples that serialize_reading understands
+READING_COLUMNS = [getattr(WeatherData, field) for field in READING_FIELDS]
+
+# (position, enum key) of the enum values inside a READING_COLUMNS tuple
+_ENUM_POSITIONS = [(READING_FIELDS.index(column), ENUM_KEYS[column]) for column in ENUM_COLUMNS]
+_TIMESTAMP_POSITION = READING_FIELDS.index('timestamp')
+
+
+def enum_value(column, value):
+    return {'type': ENUM_TYPE, 'key': ENUM_KEYS[column], 'value': value}
+
+
+# Response body of one reading selected as READING_COLUMNS
+def serialize_reading(row):
+    values = list(row)
+    values[_TIMESTAMP_POSITION] = str(values[_TIMESTAMP_POSITION])
+    for position, key in _ENUM_POSITIONS:
+        values[position] = {'type': ENUM_TYPE, 'key': key, 'value': values[position]}
+    return dict(zip(READING_FIELDS, values))
+
+
+# Response body of one bucket: column averages plus the most frequent enum values
+def serialize_averages(aggregate):
+    averages = aggregate.averages()
+    for column, value in aggregate.modes().items():
+        averages[column] = enum_value(column, value)
+    return averages
+
+
+# Encode a response body as UTF-8 JSON bytes
+def dumps(payload):
+    started = time.perf_counter()
+    if orjson is not None:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(payload, separators=(',', ':')).encode()
+    record_serialization(time.perf_counter() - started)
+    return body
+
+
+# NDJSON lines of a batch of rows selected in the order of fields, enum values are exported bare
+def ndjson_lines(fields, rows):
+    timestamp_position = fields.index('timestamp')
+    lines = []
+    for row in rows:
+        values = list(row)
+        values[timestamp_position] = str(values[timestamp_position])
+        lines.append(dumps(dict(zip(fields, values))))
+    lines.append(b'')
+    return b'\n'.join(lines)
+
+
+# CSV lines of a batch of rows, pass the field names as a single row for the header
+def csv_lines(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue().encode()
@@ -0,0 +1,62 @@
+import datetime
+import os
+import tempfile
+
+import pytest
+
+# The database modules read DATABASE_URL on import
+os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/test.db'
+
+import benchmark
+import models
+from aggregation import aggregate_buckets
+from database import Base, Session, engine
+from hot_store import HotStore
+from ingest import ingest_archive, new_report
+from rollups import rollup_aggregate_buckets
+
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+
+
+# Two days of readings, a day without any, then one more day
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    Base.metadata.create_all(engine)
+    folder = tmp_path_factory.mktemp('archives')
+    for name, start, days in (('first.zip', datetime.datetime(2023, 5, 1), 2),
+                              ('second.zip', datetime.datetime(2023, 5, 4), 1)):
+        benchmark.write_archive(str(folder / name), start, days, seed=days)
+        ingest_archive(str(folder / name), batch_size=500, workers=1, report=new_report(1))
+    store = HotStore(enabled=True)
+    store.warm()
+    yield store
+    Session.remove()
+    Base.metadata.drop_all(engine)
+
+
+def _summary(bucket):
+    return bucket.start, bucket.end, bucket.count, bucket.mins, bucket.maxs, bucket.modes()
+
+
+@pytest.mark.parametrize('start, end, width', [
+    (datetime.datetime(2023, 5, 2, 18), datetime.datetime(2023, 5, 4, 6), HOUR),
+    (datetime.datetime(2023, 5, 1), datetime.datetime(2023, 5, 5), DAY),
+    (datetime.datetime(2023, 5, 1, 2, 35), datetime.datetime(2023, 5, 4, 21, 10), 7 * HOUR),
+], ids=['hourly', 'daily', 'unaligned-7h'])
+def test_bucket_paths_agree(store, start, end, width):
+    session = Session()
+    grouped = aggregate_buckets(session, start, end, width)
+    rolled_up = rollup_aggregate_buckets(session, start, end, width)
+    in_memory = store.aggregate_buckets(start, end, width)
+
+    assert in_memory is not None
+    assert any(bucket.count == 0 for bucket in grouped)
+    assert sum(bucket.count for bucket in grouped) > 0
+    for other in (rolled_up, in_memory):
+        assert [_summary(bucket) for bucket in other] == [_summary(bucket) for bucket in grouped]
+        for bucket, expected in zip(other, grouped):
+            averages, expected_averages = bucket.averages(), expected.averages()
+            assert averages.keys() == expected_averages.keys()
+            for column, value in expected_averages.items():
+                assert averages[column] == (None if value is None else pytest.approx(value))